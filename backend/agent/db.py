@@ -0,0 +1,53 @@
+from sqlalchemy import event, inspect, text
+from sqlmodel import SQLModel, create_engine
+from . import models  # noqa: F401 — регистрирует таблицы в SQLModel.metadata
+from .config import settings
+
+def make_engine(url: str):
+    if url.startswith("sqlite"):
+        # check_same_thread=False: сессии живут в пуле воркеров; timeout — ожидание блокировки на уровне драйвера
+        engine = create_engine(url, echo=False, connect_args={"check_same_thread": False, "timeout": settings.db_busy_timeout_ms / 1000})
+
+        @event.listens_for(engine, "connect")
+        def _pragmas(dbapi_conn, _record):
+            # WAL: читатели не блокируют писателя и наоборот; NORMAL в WAL безопасен и без fsync на каждый коммит
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute(f"PRAGMA busy_timeout={int(settings.db_busy_timeout_ms)}")
+            cur.execute("PRAGMA foreign_keys=ON")
+            cur.execute("PRAGMA temp_store=MEMORY")
+            cur.execute("PRAGMA cache_size=-20000")
+            cur.execute("PRAGMA mmap_size=134217728")
+            cur.close()
+        return engine
+    # Postgres и прочие серверные БД: обычный пул соединений с проверкой живости
+    return create_engine(url, echo=False, pool_size=settings.db_pool_size, max_overflow=settings.db_pool_size, pool_pre_ping=True)
+
+def _sql_default(col, dialect) -> str:
+    d = col.default
+    if d is None or not d.is_scalar: return ""
+    v = d.arg
+    if isinstance(v, bool): return f" DEFAULT {int(v)}" if dialect.name == "sqlite" else f" DEFAULT {str(v).upper()}"
+    if isinstance(v, (int, float)): return f" DEFAULT {v}"
+    return " DEFAULT '" + str(v).replace("'", "''") + "'"
+
+def migrate(engine):
+    # create_all создаёт только недостающие таблицы. Для существующих БД досоздаём
+    # новые колонки и индексы — операции идемпотентны и выполняются при каждом старте.
+    SQLModel.metadata.create_all(engine)
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            have = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in have: continue
+                ddl = col.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {col.name} {ddl}{_sql_default(col, engine.dialect)}'))
+            for idx in table.indexes:
+                idx.create(conn, checkfirst=True)
+        if engine.dialect.name == "sqlite":
+            conn.execute(text("PRAGMA optimize"))
+
+engine = make_engine(settings.database_url)
+migrate(engine)
@@ -0,0 +1,60 @@
+import asyncio, threading
+from typing import Dict, Set
+from .config import settings
+
+# Подписка одного SSE-клиента. Очередь ограничена: медленный клиент не съест память —
+# при переполнении новые события отбрасываются, а клиент догоняет их из БД по курсору (StepLog.id).
+class Subscription:
+    def __init__(self, pid: int, maxsize: int):
+        self.pid = pid
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.loop = asyncio.get_running_loop()
+        self.overflow = False
+
+    def _offer(self, event: dict):
+        if self.overflow: return
+        if self.queue.full():
+            self.overflow = True
+            return
+        self.queue.put_nowait(event)
+
+    def reset(self):
+        # вызывается потребителем перед догонкой из БД
+        while not self.queue.empty(): self.queue.get_nowait()
+        self.overflow = False
+
+# In-process pub/sub логов: отдельная очередь на каждого подписчика проекта
+class Broker:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._subs: Dict[int, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, pid: int) -> Subscription:
+        sub = Subscription(pid, self.maxsize)
+        with self._lock: self._subs.setdefault(pid, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            subs = self._subs.get(sub.pid)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs: del self._subs[sub.pid]
+
+    def publish(self, pid: int, event: dict):
+        # Можно звать из любого потока: в чужой event loop событие передаётся через call_soon_threadsafe
+        with self._lock: subs = list(self._subs.get(pid, ()))
+        if not subs: return
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        for sub in subs:
+            if sub.loop is current: sub._offer(event)
+            elif not sub.loop.is_closed(): sub.loop.call_soon_threadsafe(sub._offer, event)
+
+    def subscribers(self, pid: int) -> int:
+        with self._lock: return len(self._subs.get(pid, ()))
+
+broker = Broker(settings.stream_queue_size)
@@ -1,40 +1,150 @@
-import pathlib
-from git import Repo
-from typing import Optional
+import pathlib, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from git import Actor, Repo
+from typing import List, Optional
+from . import metrics
+
+MAX_REPOS = 64
+ADD_BATCH = 500
+# Пути из status — имена файлов, а не шаблоны: ":odd", "*.py" и т.п. git должен понимать буквально
+LITERAL = {"GIT_LITERAL_PATHSPECS": "1"}
+# Служебные файлы агента, которые не должны попадать в историю проекта
+SKIP_PATHS = {".agent/test_cache.json"}
+
+# Кеш открытых репозиториев: Repo держит persistent-процессы git cat-file, повторно их не поднимаем.
+# Один lock на workspace — GitPython не потокобезопасен. Repo закрывается только когда им никто не пользуется:
+# занятые записи вытеснение пропускает, а сброшенную (invalidate) закрывает последний пользователь.
+class _Entry:
+    __slots__ = ("repo", "lock", "users", "dropped")
+    def __init__(self, repo: Repo):
+        self.repo, self.lock, self.users, self.dropped = repo, threading.RLock(), 0, False
+
+_repos: "OrderedDict[str, _Entry]" = OrderedDict()
+_repos_lock = threading.Lock()
+
+def _key(workspace_path: str) -> str:
+    return str(pathlib.Path(workspace_path).resolve())
+
+@contextmanager
+def repo_for(workspace_path: str):
+    key = _key(workspace_path)
+    with _repos_lock:
+        entry = _repos.get(key)
+        if entry is None:
+            entry = _repos[key] = _Entry(Repo(key))
+            for old_key in [k for k, e in _repos.items() if e.users == 0 and k != key][:max(0, len(_repos) - MAX_REPOS)]:
+                _repos.pop(old_key).repo.close()
+        else:
+            _repos.move_to_end(key)
+        entry.users += 1
+    try:
+        with entry.lock:
+            yield entry.repo
+    finally:
+        with _repos_lock:
+            entry.users -= 1
+            if entry.dropped and entry.users == 0: entry.repo.close()
+
+def invalidate_repo(workspace_path: str | None = None):
+    # Явный сброс: workspace удалён/пересоздан или .git изменён снаружи. Без аргумента — все
+    with _repos_lock:
+        keys = list(_repos) if workspace_path is None else [_key(workspace_path)]
+        for key in keys:
+            entry = _repos.pop(key, None)
+            if entry is None: continue
+            if entry.users: entry.dropped = True
+            else: entry.repo.close()
 
 def init_repo(workspace_path: str, remote_url: Optional[str], token: Optional[str]) -> str:
     wp = pathlib.Path(workspace_path)
-    repo = Repo.init(wp) if not (wp / ".git").exists() else Repo(wp)
-    if remote_url:
-        if token and remote_url.startswith("https://") and f"{token}@" not in remote_url:
-            remote_url = remote_url.replace("https://", f"https://{token}@")
-        try:
-            if "origin" in [r.name for r in repo.remotes]:
-                repo.delete_remote("origin")
-            repo.create_remote("origin", remote_url)
-        except Exception:
-            pass
-    return str(repo.working_dir)
+    if not (wp / ".git").exists():
+        invalidate_repo(str(wp)); Repo.init(wp).close()
+    with repo_for(str(wp)) as repo:
+        if remote_url:
+            if token and remote_url.startswith("https://") and f"{token}@" not in remote_url:
+                remote_url = remote_url.replace("https://", f"https://{token}@")
+            try:
+                if "origin" in [r.name for r in repo.remotes]:
+                    repo.delete_remote("origin")
+                repo.create_remote("origin", remote_url)
+            except Exception:
+                pass
+        return str(repo.working_dir)
 
 def new_branch(workspace_path: str, branch_name: str) -> str:
-    repo = Repo(workspace_path)
-    head = repo.create_head(branch_name) if branch_name not in repo.heads else repo.heads[branch_name]
-    head.checkout()
-    return head.name
+    with repo_for(workspace_path) as repo:
+        head = repo.create_head(branch_name) if branch_name not in repo.heads else repo.heads[branch_name]
+        head.checkout()
+        return head.name
+
+def changed_paths(repo: Repo) -> List[str]:
+    # Один проход git status вместо add -A + is_dirty (два полных обхода рабочей копии).
+    # -z: пути без кавычек; у переименований за новым путём идёт старый — берём оба
+    out = repo.git.status("--porcelain=v1", "-z", "--untracked-files=all")
+    items, paths = out.split("\0"), []
+    i = 0
+    while i < len(items):
+        entry = items[i]; i += 1
+        if len(entry) < 4: continue
+        paths.append(entry[3:])
+        if entry[0] in "RC": paths.append(items[i]); i += 1
+    return paths
 
+@metrics.timed("git_commit")
 def commit_all(workspace_path: str, message: str) -> str:
-    repo = Repo(workspace_path)
-    repo.git.add(A=True)
-    if repo.is_dirty():
-        repo.index.commit(message)
+    with repo_for(workspace_path) as repo:
+        changed = [p for p in changed_paths(repo) if p not in SKIP_PATHS]
+        if not changed: return "nothing_to_commit"
+        for i in range(0, len(changed), ADD_BATCH):
+            repo.git.add("-A", "--", *changed[i:i + ADD_BATCH], env=LITERAL)
+        _commit(repo, message)
         return "committed"
-    return "nothing_to_commit"
 
+def _commit(repo: Repo, message: str) -> str:
+    # repo.index.commit разбирает весь индекс и пишет деревья на Python — на больших workspace это секунды.
+    # write-tree + commit-tree делают то же в git; автор — как у GitPython (конфиг или user@host)
+    cr = repo.config_reader()
+    author, committer = Actor.author(cr), Actor.committer(cr)
+    env = {"GIT_AUTHOR_NAME": author.name, "GIT_AUTHOR_EMAIL": author.email,
+           "GIT_COMMITTER_NAME": committer.name, "GIT_COMMITTER_EMAIL": committer.email}
+    tree = repo.git.write_tree()
+    parents = ["-p", repo.head.commit.hexsha] if repo.head.is_valid() else []
+    sha = repo.git.commit_tree(tree, *parents, "-m", message, env=env)
+    repo.git.update_ref("HEAD", sha)
+    return sha
+
+@metrics.timed("git_tree_hash")
+def tree_hash(workspace_path: str, exclude: tuple = (".agent",)) -> Optional[str]:
+    # Хеш дерева рабочей копии (с неотслеживаемыми файлами, без .gitignore) без коммита и без изменения
+    # настоящего индекса: отдельный индекс-файл, его stat-кеш делает повторные вызовы дешёвыми
+    wp = pathlib.Path(workspace_path).resolve()
+    if not (wp / ".git").exists(): return None
+    env = {"GIT_INDEX_FILE": str(wp / ".git" / "agent-tree-index")}
+    try:
+        with repo_for(str(wp)) as repo:
+            repo.git.add("-A", env=env)
+            if exclude: repo.git.rm("-r", "-q", "--cached", "--ignore-unmatch", "--", *exclude, env=env)
+            return repo.git.write_tree(env=env)
+    except Exception:
+        return None
+
+def changed_between(workspace_path: str, old_tree: str, new_tree: str) -> Optional[List[str]]:
+    # None — старое дерево недоступно (например, после gc), вызывающий делает полный прогон
+    try:
+        with repo_for(workspace_path) as repo:
+            out = repo.git.diff("--name-only", "-z", old_tree, new_tree)
+    except Exception:
+        return None
+    # -z: пути без кавычек и экранирования (не-ASCII имена иначе приходят в виде "\320\277...")
+    return [p for p in out.split("\0") if p]
+
+@metrics.timed("git_push")
 def push_current(workspace_path: str, set_upstream: bool = True) -> str:
-    repo = Repo(workspace_path)
-    current = repo.active_branch.name
-    if set_upstream:
-        repo.git.push("--set-upstream", "origin", current)
-    else:
-        repo.git.push("origin", current)
-    return current
+    with repo_for(workspace_path) as repo:
+        current = repo.active_branch.name
+        if set_upstream:
+            repo.git.push("--set-upstream", "origin", current)
+        else:
+            repo.git.push("origin", current)
+        return current
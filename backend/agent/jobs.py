@@ -0,0 +1,146 @@
+import threading, uuid, datetime, asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+from .config import settings
+
+KEEP_FINISHED = 500
+
+@dataclass
+class Job:
+    pid: int
+    kind: str                # agent_step|index|...
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    status: str = "queued"   # queued|running|parked|done|error|cancelled
+    created_at: datetime.datetime = field(default_factory=datetime.datetime.utcnow)
+    started_at: Optional[datetime.datetime] = None
+    finished_at: Optional[datetime.datetime] = None
+    result: Any = None
+    error: str = ""
+    future: Future = field(default_factory=Future, repr=False)
+
+    def as_dict(self) -> dict:
+        iso = lambda d: d.isoformat() if d else None
+        return {"id": self.id, "project_id": self.pid, "kind": self.kind, "status": self.status,
+                "created_at": iso(self.created_at), "started_at": iso(self.started_at), "finished_at": iso(self.finished_at),
+                "result": self.result if isinstance(self.result, (dict, list, str, int, float, bool, type(None))) else str(self.result),
+                "error": self.error}
+
+class JobCancelled(Exception):
+    pass
+
+class JobParked(Exception):
+    # Задаче нужно подождать (пауза, окно расписания): воркер освобождается, задача остаётся первой в очереди
+    # проекта и после resume() вызывается заново с kwargs, дополненными resume (прогресс, чтобы не повторять работу)
+    def __init__(self, reason: str, resume: Optional[dict] = None):
+        super().__init__(reason); self.resume = resume or {}
+
+# Пул воркеров для тяжёлой работы агента. Задачи одного проекта выполняются строго по очереди
+# (не гоняются за один workspace), задачи разных проектов — параллельно.
+class JobManager:
+    def __init__(self, workers: int):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="agent-job")
+        self._jobs: Dict[str, Job] = {}
+        self._queues: Dict[int, Deque[Job]] = {}
+        self._wake: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def submit(self, pid: int, kind: str, fn: Callable, *args, **kwargs) -> Job:
+        job = Job(pid=pid, kind=kind)
+        with self._lock:
+            self._jobs[job.id] = job
+            q = self._queues.setdefault(pid, deque())
+            q.append((job, fn, args, kwargs))
+            if len(q) == 1: self._pool.submit(self._run, pid)
+            self._trim()
+        return job
+
+    def _run(self, pid: int):
+        with self._lock:
+            job, fn, args, kwargs = self._queues[pid][0]
+            job.status = "running"; job.started_at = job.started_at or datetime.datetime.utcnow()
+            self._wake.discard(pid)
+        parked = False
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = "done"
+            job.future.set_result(job.result)
+        except JobParked as e:
+            with self._lock:
+                self._queues[pid][0] = (job, fn, args, dict(kwargs, **e.resume))
+                job.status = "parked"; job.error = str(e)
+                # resume() пришёл, пока задача ещё работала, — условие могло уже смениться, проверим сразу
+                if pid in self._wake: self._wake.discard(pid); self._resubmit(pid)
+            parked = True
+        except JobCancelled as e:
+            job.status = "cancelled"; job.error = str(e)
+            job.future.set_exception(e)
+        except Exception as e:
+            job.status = "error"; job.error = f"{type(e).__name__}: {e}"
+            job.future.set_exception(e)
+        finally:
+            if not parked:
+                job.finished_at = datetime.datetime.utcnow()
+                with self._lock:
+                    q = self._queues[pid]; q.popleft()
+                    if q: self._pool.submit(self._run, pid)
+                    else: del self._queues[pid]
+
+    def _resubmit(self, pid: int):
+        job = self._queues[pid][0][0]
+        job.status = "queued"; job.error = ""
+        self._pool.submit(self._run, pid)
+
+    def resume(self, pid: int) -> bool:
+        # Пауза снята или открылось окно расписания: запаркованная задача снова встаёт в пул
+        with self._lock:
+            q = self._queues.get(pid)
+            if not q: return False
+            if q[0][0].status != "parked":
+                if q[0][0].status == "running": self._wake.add(pid)
+                return False
+            self._resubmit(pid)
+            return True
+
+    def cancel_queued(self, pid: int) -> int:
+        # Снимаем с очереди всё, что ещё не начало выполняться (текущая задача остановится сама по Project.control);
+        # запаркованная задача не выполняется — её снимаем тоже
+        n = 0
+        with self._lock:
+            q = self._queues.get(pid)
+            if not q: return 0
+            running, rest = q[0], list(q)[1:]
+            parked = running[0].status == "parked"
+            for job, *_ in rest + ([running] if parked else []):
+                job.status = "cancelled"; job.finished_at = datetime.datetime.utcnow()
+                job.future.set_exception(JobCancelled("Снята с очереди"))
+                n += 1
+            q.clear()
+            if parked: del self._queues[pid]
+            else: q.append(running)
+        return n
+
+    def active(self, pid: int) -> bool:
+        with self._lock:
+            return bool(self._queues.get(pid))
+
+    def get(self, jid: str) -> Optional[Job]:
+        return self._jobs.get(jid)
+
+    def list(self, pid: int) -> List[Job]:
+        with self._lock:
+            return [j for j in self._jobs.values() if j.pid == pid]
+
+    async def wait(self, job: Job):
+        return await asyncio.wrap_future(job.future)
+
+    def _trim(self):
+        done = [j for j in self._jobs.values() if j.finished_at]
+        for j in sorted(done, key=lambda j: j.finished_at)[:max(0, len(done) - KEEP_FINISHED)]:
+            del self._jobs[j.id]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+jobs = JobManager(settings.job_workers)
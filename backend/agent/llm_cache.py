@@ -0,0 +1,107 @@
+import sqlite3, threading, time, hashlib
+from collections import OrderedDict
+from .config import settings
+
+TOUCH_BATCH = 100
+
+# Кеш ответов LLM: LRU в памяти + таблица SQLite на диске (переживает рестарт)
+class LLMCache:
+    def __init__(self, path: str, max_items: int, max_rows: int, ttl: float, enabled: bool = True):
+        self.enabled = enabled
+        self.max_items, self.max_rows, self.ttl = max_items, max_rows, ttl
+        self.hits = self.disk_hits = self.misses = self.puts = 0
+        self._mem: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._touched: dict[str, float] = {}
+        self._db = None
+        if enabled and path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed ON llm_cache (accessed)")
+            self._db.commit()
+
+    @staticmethod
+    def key(model: str, endpoint: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\n{endpoint}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled: return None
+        hit = self.get_memory(key)
+        return hit if hit is not None else self.get_disk(key)
+
+    def get_memory(self, key: str) -> str | None:
+        # Только память, без SQLite — можно звать прямо из event loop; промах не считается (дальше будет диск)
+        if not self.enabled: return None
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(key)
+            if item and item[0] > now:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item: del self._mem[key]
+            return None
+
+    def get_disk(self, key: str) -> str | None:
+        # Обращение к SQLite — под своим lock, попадания в память его не ждут.
+        # Время обращения пишется не сразу, а пачкой (вместе со следующим put или по TOUCH_BATCH)
+        if not self.enabled: return None
+        row = None
+        if self._db is not None:
+            with self._db_lock:
+                row = self._db.execute("SELECT value, created FROM llm_cache WHERE key=?", (key,)).fetchone()
+                if row and row[1] + self.ttl > time.time():
+                    self._touched[key] = time.time()
+                    if len(self._touched) >= TOUCH_BATCH: self._flush_touched(); self._db.commit()
+                else: row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1; return None
+            self._remember(key, row[0], row[1] + self.ttl)
+            self.hits += 1; self.disk_hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str):
+        if not self.enabled or not value: return
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now + self.ttl)
+            self.puts += 1; puts = self.puts
+        if self._db is None: return
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?,?,?,?)", (key, value, now, now))
+            self._touched.pop(key, None); self._flush_touched()
+            # Чистим диск не на каждой записи: просроченное и всё сверх max_rows (по давности обращения)
+            if puts % 100 == 0:
+                self._db.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl,))
+                self._db.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+            self._db.commit()
+
+    def _flush_touched(self):
+        if self._touched:
+            self._db.executemany("UPDATE llm_cache SET accessed=? WHERE key=?", [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+
+    def _remember(self, key: str, value: str, expires: float):
+        self._mem[key] = (expires, value); self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def clear(self):
+        with self._lock: self._mem.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._touched.clear(); self._db.execute("DELETE FROM llm_cache"); self._db.commit()
+
+    def stats(self) -> dict:
+        rows = 0
+        if self._db is not None:
+            with self._db_lock: rows = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        with self._lock:
+            total = self.hits + self.misses
+            return {"enabled": self.enabled, "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 4) if total else 0.0, "memory_items": len(self._mem), "disk_rows": rows}
+
+cache = LLMCache(settings.llm_cache_path, settings.llm_cache_items, settings.llm_cache_rows, settings.llm_cache_ttl, settings.llm_cache)
@@ -1,22 +1,127 @@
-import requests, json
+import asyncio, requests, json, time, httpx
+from requests.adapters import HTTPAdapter
+from typing import AsyncIterator
 from .config import settings
+from .llm_cache import cache as _cache
+from .retrieval import estimate_tokens
+from . import metrics
 
-def call_llm(prompt: str) -> str:
+# Один пул соединений на процесс: keep-alive вместо нового TCP/TLS на каждый вызов
+_http = requests.Session()
+_http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=max(8, settings.llm_concurrency * 2)))
+_http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(8, settings.llm_concurrency * 2)))
+_ahttp: httpx.AsyncClient | None = None
+
+def _async_client() -> httpx.AsyncClient:
+    global _ahttp
+    if _ahttp is None or _ahttp.is_closed:
+        _ahttp = httpx.AsyncClient(timeout=httpx.Timeout(settings.llm_timeout, connect=10.0),
+                                   limits=httpx.Limits(max_connections=max(8, settings.llm_concurrency * 2), max_keepalive_connections=8))
+    return _ahttp
+
+async def aclose():
+    global _ahttp
+    if _ahttp is not None:
+        await _ahttp.aclose(); _ahttp = None
+
+def _cache_key(payload: dict) -> str:
+    return _cache.key(payload["model"], settings.llm_endpoint, payload["prompt"])
+
+def _generate(payload: dict, timeout: float | None = None, retries: int | None = None, cache: bool = True) -> str:
+    key = _cache_key(payload) if cache else None
+    if key and (hit := _cache.get(key)) is not None:
+        metrics.count("llm_cache_total", result="hit")
+        return hit
+    if key: metrics.count("llm_cache_total", result="miss")
+    text = _post(payload, timeout, retries)
+    if key: _cache.put(key, text)
+    return text
+
+def _post(payload: dict, timeout: float | None, retries: int | None) -> str:
+    timeout = settings.llm_timeout if timeout is None else timeout
+    retries = settings.llm_retries if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            with metrics.span("llm_request"):
+                r = _http.post(settings.llm_endpoint, json=payload, timeout=timeout)
+                r.raise_for_status()
+                out = r.json()
+            text = out.get("response") or out.get("text") or str(out)
+            if metrics.enabled: _count_usage(payload["prompt"], text, len(r.content), out)
+            return text
+        except requests.RequestException as e:
+            # 4xx — ошибка самого запроса, повтор не поможет
+            resp = getattr(e, "response", None)
+            if attempt >= retries or (resp is not None and resp.status_code < 500): raise
+            metrics.count("llm_retries_total")
+            time.sleep(min(2 ** attempt, 30))
+
+def _count_usage(prompt: str, text: str, received: int, out: dict | None = None):
+    # Ollama сообщает точные счётчики (prompt_eval_count/eval_count), OpenAI-совместимые — usage; иначе оценка
+    out = out or {}
+    usage = out.get("usage") or {}
+    metrics.count("llm_tokens_total", out.get("prompt_eval_count") or usage.get("prompt_tokens") or estimate_tokens(prompt), direction="in")
+    metrics.count("llm_tokens_total", out.get("eval_count") or usage.get("completion_tokens") or estimate_tokens(text), direction="out")
+    metrics.count("llm_bytes_total", len(prompt.encode("utf-8")), direction="sent")
+    metrics.count("llm_bytes_total", received, direction="received")
+
+def _chunk_text(line: str) -> str | None:
+    # Ollama отдаёт NDJSON ({"response": ..., "done": ...}), OpenAI-совместимые серверы — SSE ("data: {...}")
+    line = line.strip()
+    if line.startswith("data:"): line = line[5:].strip()
+    if not line or line == "[DONE]": return None
+    try:
+        out = json.loads(line)
+    except ValueError:
+        return None
+    if "response" in out: return out["response"]
+    if "text" in out: return out["text"]
+    choices = out.get("choices") or []
+    if choices: return choices[0].get("text") or (choices[0].get("delta") or {}).get("content")
+    return None
+
+async def _stream(payload: dict, cache: bool = True) -> AsyncIterator[str]:
+    key = _cache_key(payload) if cache else None
+    # Память — сразу; SQLite-уровень кеша — в потоке, чтобы не блокировать event loop
+    hit = (_cache.get_memory(key) or await asyncio.to_thread(_cache.get_disk, key)) if key else None
+    if hit is not None:
+        metrics.count("llm_cache_total", result="hit")
+        yield hit
+        return
+    if key: metrics.count("llm_cache_total", result="miss")
+    parts, received = [], 0
+    with metrics.span("llm_stream"):
+        async with _async_client().stream("POST", settings.llm_endpoint, json=payload) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                received += len(line) + 1
+                tok = _chunk_text(line)
+                if tok:
+                    parts.append(tok)
+                    yield tok
+    if metrics.enabled: _count_usage(payload["prompt"], "".join(parts), received)
+    if key: await asyncio.to_thread(_cache.put, key, "".join(parts))
+
+def call_llm(prompt: str, timeout: float | None = None, retries: int | None = None, cache: bool = True) -> str:
     payload={"model":settings.llm_model,"prompt":prompt,"stream":False}
-    r = requests.post(settings.llm_endpoint, json=payload, timeout=120)
-    r.raise_for_status()
-    out = r.json()
-    return out.get("response") or out.get("text") or str(out)
+    return _generate(payload, timeout, retries, cache)
 
-def chat_llm(system_prompt: str, history: list[dict]):
+def chat_llm(system_prompt: str, history: list[dict], cache: bool = True):
     payload={"model":settings.llm_model,"prompt": system_prompt + "\n" + _history_to_text(history), "stream": False}
-    r = requests.post(settings.llm_endpoint, json=payload, timeout=120)
-    r.raise_for_status()
-    out = r.json()
-    return out.get("response") or out.get("text") or str(out)
+    return _generate(payload, cache=cache)
+
+def stream_llm(prompt: str, cache: bool = True) -> AsyncIterator[str]:
+    return _stream({"model":settings.llm_model,"prompt":prompt,"stream":True}, cache)
+
+def chat_llm_stream(system_prompt: str, history: list[dict], cache: bool = True) -> AsyncIterator[str]:
+    return _stream({"model":settings.llm_model,"prompt": system_prompt + "\n" + _history_to_text(history), "stream": True}, cache)
+
+def cache_stats() -> dict:
+    return _cache.stats()
 
 def _history_to_text(h):
+    # Размер истории ограничивает memory.history_for (бюджет токенов), здесь не режем
     lines=[]; 
-    for m in h[-12:]:
+    for m in h:
         lines.append(f"{m['role']}: {m['content']}")
     return "\n".join(lines)
@@ -0,0 +1,85 @@
+import datetime, threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from .models import ChatMessage, ChatSummary
+from .llm_client import call_llm
+from .retrieval import estimate_tokens
+from .runner_utils import engine, log
+from .config import settings
+
+LOAD_LIMIT = 200         # больше последних реплик в память не поднимаем никогда
+TURN_OVERHEAD = 4        # "role: " и перевод строки
+
+def _recent(session: Session, pid: int) -> list[ChatMessage]:
+    rows = session.exec(select(ChatMessage).where(ChatMessage.project_id==pid).order_by(ChatMessage.id.desc()).limit(LOAD_LIMIT)).all()
+    return rows[::-1]
+
+def _pack(rows: list[ChatMessage], budget: int) -> list[ChatMessage]:
+    # Свежие реплики целиком, пока влезают в бюджет; последняя (текущий вопрос) — всегда
+    kept, used = [], 0
+    for r in reversed(rows):
+        t = estimate_tokens(r.content) + TURN_OVERHEAD
+        if kept and used + t > budget: break
+        kept.append(r); used += t
+    return kept[::-1]
+
+def _summary(session: Session, pid: int) -> ChatSummary | None:
+    return session.exec(select(ChatSummary).where(ChatSummary.project_id==pid)).first()
+
+def history_for(session: Session, pid: int, budget: int | None = None) -> tuple[str, list[dict]]:
+    # Память разговора: сводка старых реплик + последние реплики в пределах бюджета токенов
+    budget = settings.chat_history_tokens if budget is None else budget
+    kept = _pack(_recent(session, pid), budget)
+    summ = _summary(session, pid)
+    return (summ.content if summ else ""), [{"role": m.role, "content": m.content} for m in kept]
+
+def refresh_summary(session: Session, pid: int, budget: int | None = None) -> bool:
+    # Реплики, вытесненные из окна, дописываются в сводку одним запросом к LLM —
+    # только когда их набралось на треть бюджета сводки, а не после каждого сообщения
+    budget = settings.chat_history_tokens if budget is None else budget
+    rows = _recent(session, pid)
+    kept = _pack(rows, budget)
+    if not kept: return False
+    summ = _summary(session, pid)
+    upto = summ.upto_id if summ else 0
+    evicted = [r for r in rows if upto < r.id < kept[0].id]
+    if sum(estimate_tokens(r.content) for r in evicted) < settings.chat_summary_tokens // 3: return False
+    turns = "\n".join(f"{r.role}: {r.content}" for r in evicted)
+    prompt = (f"Обнови краткое содержание разговора пользователя с агентом проекта. Сохрани договорённости, решения и открытые вопросы. "
+              f"Не больше {settings.chat_summary_tokens} токенов, простыми словами.\n"
+              f"Текущее содержание:\n{summ.content if summ else '(пусто)'}\n---\nНовые реплики:\n{turns}")
+    text = call_llm(prompt)
+    if not summ: summ = ChatSummary(project_id=pid)
+    summ.content = text; summ.upto_id = evicted[-1].id; summ.updated_at = datetime.datetime.utcnow()
+    session.add(summ)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback(); return False   # сводку параллельно создал другой процесс — его версия остаётся
+    return True
+
+# Обновление сводки — запрос к LLM, ответу пользователя его ждать незачем: выполняется в фоне.
+# Проекты обновляются параллельно (в пределах llm_concurrency), один проект — не больше одного прогона за раз;
+# запрос во время обновления не теряется — после текущего прогона будет ещё один.
+_pool = ThreadPoolExecutor(max_workers=max(1, settings.llm_concurrency), thread_name_prefix="chat-summary")
+_active: dict[int, bool] = {}    # pid -> нужен повторный прогон
+_lock = threading.Lock()
+
+def schedule_refresh(pid: int):
+    with _lock:
+        if pid in _active:
+            _active[pid] = True; return
+        _active[pid] = False
+    _pool.submit(_refresh_loop, pid)
+
+def _refresh_loop(pid: int):
+    while True:
+        try:
+            with Session(engine) as s: refresh_summary(s, pid)
+        except Exception as e:
+            log(None, pid, "error", f"Не удалось обновить сводку разговора: {e}")
+        with _lock:
+            if not _active[pid]:
+                del _active[pid]; return
+            _active[pid] = False
@@ -0,0 +1,157 @@
+import bisect, contextvars, functools, json, threading, time
+from typing import Dict, Optional, Tuple
+from .config import settings
+
+# Границы корзин гистограммы (секунды): от быстрых коммитов в БД до долгих ответов LLM и прогонов тестов
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+PREFIX = "agent_"
+
+enabled = settings.metrics_enabled
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1); self.sum = 0.0; self.count = 0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(BUCKETS, v)] += 1; self.sum += v; self.count += 1
+
+# Хранилище метрик процесса: гистограммы длительностей участков и счётчики (токены, байты, ошибки)
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hist: Dict[Tuple[str, tuple], Histogram] = {}
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+
+    def observe(self, name: str, seconds: float, labels: tuple = ()):
+        key = (name, labels)
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None: h = self._hist[key] = Histogram()
+            h.observe(seconds)
+
+    def inc(self, name: str, value: float = 1, labels: tuple = ()):
+        key = (name, labels)
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self) -> str:
+        # Текстовый формат Prometheus (exposition format 0.0.4)
+        with self._lock:
+            hist = {k: (list(h.counts), h.sum, h.count) for k, h in self._hist.items()}
+            counters = dict(self._counters)
+        out, typed = [], set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed: out.append(f"# TYPE {PREFIX}{name} counter"); typed.add(name)
+            out.append(f"{PREFIX}{name}{_labels(labels)} {_num(value)}")
+        for (name, labels), (counts, total, count) in sorted(hist.items()):
+            if name not in typed: out.append(f"# TYPE {PREFIX}{name} histogram"); typed.add(name)
+            acc = 0
+            for le, c in zip(BUCKETS + (float("inf"),), counts):
+                acc += c
+                out.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', '+Inf' if le == float('inf') else _num(le)),))} {acc}")
+            out.append(f"{PREFIX}{name}_sum{_labels(labels)} {_num(total)}")
+            out.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+        return "\n".join(out) + "\n"
+
+def _labels(labels: tuple) -> str:
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ") + '"' for k, v in labels) + "}"
+
+def _num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+registry = Registry()
+
+# Разбивка по текущему шагу агента: участки и счётчики, сделанные внутри step(), складываются сюда.
+# В пул потоков контекст передаётся через wrap() — иначе вызовы LLM из summarize_many потеряются.
+class StepBreakdown:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: Dict[str, list] = {}      # имя -> [количество, секунды]
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            s = self.spans.setdefault(name, [0, 0.0]); s[0] += 1; s[1] += seconds
+
+    def add_counter(self, name: str, value: float):
+        with self._lock: self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"total_s": round(time.perf_counter() - self.started, 3),
+                    "spans": {k: {"count": c, "seconds": round(s, 3)} for k, (c, s) in sorted(self.spans.items())},
+                    "counters": dict(sorted(self.counters.items()))}
+
+_step: contextvars.ContextVar[Optional[StepBreakdown]] = contextvars.ContextVar("metrics_step", default=None)
+
+class Span:
+    __slots__ = ("name", "labels", "started")
+    def __init__(self, name: str, labels: tuple):
+        self.name, self.labels = name, labels
+
+    def __enter__(self):
+        self.started = time.perf_counter(); return self
+
+    def __exit__(self, exc_type, exc, tb):
+        took = time.perf_counter() - self.started
+        labels = (("span", self.name),) + self.labels
+        registry.observe("span_seconds", took, labels)
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit): registry.inc("span_errors_total", 1, labels)
+        step = _step.get()
+        if step is not None: step.add_span(self.name, took)
+        return False
+
+class _Noop:
+    __slots__ = ()
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+_NOOP = _Noop()
+
+def span(name: str, **labels):
+    # Выключенные метрики: один if и общий пустой объект — без замера времени и блокировок
+    if not enabled: return _NOOP
+    return Span(name, tuple(sorted(labels.items())))
+
+def timed(name: str, **labels):
+    def deco(fn):
+        if not enabled: return fn
+        lbl = tuple(sorted(labels.items()))
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Span(name, lbl): return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def count(name: str, value: float = 1, **labels):
+    # name — полное имя счётчика без префикса (llm_tokens_total и т.п.)
+    if not enabled or not value: return
+    registry.inc(name, value, tuple(sorted(labels.items())))
+    step = _step.get()
+    if step is not None: step.add_counter(name + "".join(f".{v}" for _, v in sorted(labels.items())), value)
+
+class step:
+    # with metrics.step(): ... — собирает разбивку шага; step_meta() отдаёт её JSON для StepLog.meta
+    __slots__ = ("token", "breakdown")
+    def __enter__(self):
+        self.breakdown = StepBreakdown() if enabled else None
+        self.token = _step.set(self.breakdown)
+        return self.breakdown
+    def __exit__(self, *exc):
+        _step.reset(self.token); return False
+
+def step_meta(**extra) -> str:
+    b = _step.get()
+    if b is None: return ""
+    return json.dumps(dict(b.as_dict(), **extra), ensure_ascii=False)
+
+def wrap(fn):
+    # Для pool.submit: вызов в копии текущего контекста (одна копия — один вызов)
+    if not enabled: return fn
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.run(fn, *a, **kw)
+
+def render() -> str:
+    return registry.render() if enabled else "# metrics disabled\n"
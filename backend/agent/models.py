@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field
+from sqlalchemy import Index
 from typing import Optional
 from datetime import datetime
 
@@ -13,7 +14,15 @@ class Project(SQLModel, table=True):
     status: str = "idle"     # idle|running|paused|sleeping|error|done
     control: str = ""        # JSON: {pause:bool, stop:bool}
 
+class IdSequence(SQLModel, table=True):
+    # Счётчики id, раздаваемые блоками (StepLog пишется с заранее выданными id из нескольких процессов)
+    name: str = Field(primary_key=True)
+    next_id: int = 1
+
 class StepLog(SQLModel, table=True):
+    __table_args__ = (Index("ix_steplog_project_id_id", "project_id", "id"),
+                      Index("ix_steplog_project_id_type_id", "project_id", "type", "id"),
+                      Index("ix_steplog_project_id_ts", "project_id", "ts"))
     id: Optional[int] = Field(default=None, primary_key=True)
     project_id: int
     ts: datetime = Field(default_factory=datetime.utcnow)
@@ -23,20 +32,36 @@ class StepLog(SQLModel, table=True):
     meta: str = ""           # json string
 
 class FileIndex(SQLModel, table=True):
+    __table_args__ = (Index("ix_fileindex_project_id_path", "project_id", "path"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     project_id: int
     path: str
     summary: str = ""
+    content_hash: str = ""   # sha256 содержимого на момент суммаризации
+    mtime: float = 0.0
+    size: int = 0
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class ChatMessage(SQLModel, table=True):
+    __table_args__ = (Index("ix_chatmessage_project_id_ts", "project_id", "ts"),
+                      Index("ix_chatmessage_project_id_id", "project_id", "id"))
     id: Optional[int] = Field(default=None, primary_key=True)
     project_id: int
     ts: datetime = Field(default_factory=datetime.utcnow)
     role: str = "user"       # user|assistant|system
     content: str = ""
 
+class ChatSummary(SQLModel, table=True):
+    # Одна сводка на проект: уникальность страхует от двух параллельных обновлений (в т.ч. из разных процессов)
+    __table_args__ = (Index("ux_chatsummary_project_id", "project_id", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    project_id: int
+    upto_id: int = 0         # последний ChatMessage.id, вошедший в сводку
+    content: str = ""
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
 class ProjectTask(SQLModel, table=True):
+    __table_args__ = (Index("ix_projecttask_project_id_priority", "project_id", "priority", "id"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     project_id: int
     title: str
@@ -45,6 +70,7 @@ class ProjectTask(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class WorkSchedule(SQLModel, table=True):
+    __table_args__ = (Index("ix_workschedule_project_id", "project_id"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     project_id: int
     time_window: str = "23:00-07:00"
@@ -0,0 +1,156 @@
+import asyncio, codecs, contextlib, os, re, signal, threading, time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Set
+from .config import settings
+
+READ_CHUNK = 65536
+STOP_POLL = 2.0
+# \r — тоже конец строки: прогресс-бары npm/pip перерисовывают строку без \n
+_EOL = re.compile(r"\r\n|\r|\n")
+
+# Вывод процесса с ограничением памяти: первые head байт и последние tail байт, середина выбрасывается
+class Capture:
+    def __init__(self, head: int, tail: int):
+        self.head_limit, self.tail_limit = head, tail
+        self.head: List[str] = []; self.head_size = 0
+        self.tail: deque = deque(); self.tail_size = 0
+        self.dropped = 0
+
+    def add(self, line: str):
+        # Длинная строка режется по остатку бюджета: начало — в head, конец — в tail
+        room = self.head_limit - self.head_size
+        if room > 0:
+            self.head.append(line[:room]); self.head_size += min(room, len(line))
+            line = line[room:]
+            if not line: return
+        if len(line) > self.tail_limit:
+            self.dropped += len(line) - self.tail_limit
+            line = line[len(line) - self.tail_limit:]
+        self.tail.append(line); self.tail_size += len(line)
+        while self.tail_size > self.tail_limit and self.tail:
+            old = self.tail.popleft(); self.tail_size -= len(old); self.dropped += len(old)
+
+    def text(self) -> str:
+        mid = [f"\n... [пропущено {self.dropped} байт вывода] ...\n"] if self.dropped else []
+        return "".join(self.head + mid + list(self.tail))
+
+# Все процессы живут в одном фоновом event loop: чтение stdout/stderr мультиплексируется,
+# поток на каждый пайп не нужен. Синхронный код ждёт результат через run_coroutine_threadsafe.
+class ProcessRunner:
+    def __init__(self, max_parallel: int, per_project: int):
+        self.max_parallel, self.per_project = max_parallel, per_project
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._global: Optional[asyncio.Semaphore] = None
+        self._projects: Dict[int, asyncio.Semaphore] = {}
+        self._running: Dict[int, Set[asyncio.subprocess.Process]] = {}
+        self._cancelled: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="proc-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def submit(self, coro_fn, *args):
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(coro_fn(*args), loop)
+
+    def run(self, parts: List[str], cwd: Optional[str], timeout: float, pid: Optional[int],
+            on_line: Optional[Callable[[str, str], None]], should_stop: Optional[Callable[[], bool]]) -> dict:
+        return self.submit(self._run, parts, cwd, timeout, pid, on_line, should_stop).result()
+
+    def cancel(self, pid: int) -> int:
+        # Остановка по Project.control: гасим все процессы проекта (вместе с дочерними)
+        loop = self._loop
+        if loop is None: return 0
+        return asyncio.run_coroutine_threadsafe(self._cancel(pid), loop).result(timeout=10)
+
+    async def _cancel(self, pid: int) -> int:
+        procs = list(self._running.get(pid, ()))
+        if procs: self._cancelled.add(pid)
+        for p in procs: _kill(p)
+        return len(procs)
+
+    async def _run(self, parts, cwd, timeout, pid, on_line, should_stop) -> dict:
+        if self._global is None: self._global = asyncio.Semaphore(self.max_parallel)
+        key = pid if pid is not None else -1
+        # Команды вне проекта (bootstrap, служебные) ограничены только общим лимитом, не очередью «проекта -1»
+        sem = self._projects.setdefault(key, asyncio.Semaphore(self.per_project)) if pid is not None else contextlib.nullcontext()
+        # Сначала очередь проекта, потом общий слот: ждущие своей очереди не занимают общую ёмкость
+        async with sem, self._global:
+            return await self._exec(parts, cwd, timeout, key, on_line, should_stop)
+
+    async def _exec(self, parts, cwd, timeout, key, on_line, should_stop) -> dict:
+        try:
+            proc = await asyncio.create_subprocess_exec(*parts, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                        start_new_session=True)
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        self._running.setdefault(key, set()).add(proc)
+        out = Capture(settings.cmd_output_head, settings.cmd_output_tail)
+        err = Capture(settings.cmd_output_head, settings.cmd_output_tail)
+        state = {"timeout": False, "cancelled": False, "bytes": 0}
+
+        async def pump(stream, cap: Capture, name: str):
+            # Инкрементальный декодер: многобайтный символ на границе чанков не превращается в U+FFFD
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            rest = ""
+            while True:
+                chunk = await stream.read(READ_CHUNK)
+                state["bytes"] += len(chunk)
+                text = rest + decoder.decode(chunk, final=not chunk)
+                # \r в конце придерживаем: следующий чанк может начаться с \n
+                hold = "\r" if chunk and text.endswith("\r") else ""
+                lines = _EOL.split(text[:-1] if hold else text)
+                rest = lines.pop()
+                if len(rest) > READ_CHUNK:   # вывод без переводов строки — режем принудительно
+                    lines.append(rest); rest = ""
+                rest += hold
+                for line in lines:
+                    cap.add(line + "\n")
+                    if on_line: on_line(name, line)
+                if not chunk: break
+            if rest:
+                cap.add(rest)
+                if on_line: on_line(name, rest)
+
+        async def watch():
+            deadline = time.monotonic() + timeout
+            while proc.returncode is None:
+                await asyncio.sleep(min(STOP_POLL, max(0.0, deadline - time.monotonic())))
+                if proc.returncode is not None: return
+                if time.monotonic() >= deadline:
+                    state["timeout"] = True; _kill(proc); return
+                if should_stop and await asyncio.to_thread(should_stop):
+                    state["cancelled"] = True; _kill(proc); return
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await asyncio.gather(pump(proc.stdout, out, "stdout"), pump(proc.stderr, err, "stderr"))
+            code = await proc.wait()
+        finally:
+            watcher.cancel()
+            self._running[key].discard(proc)
+            if key in self._cancelled and not self._running[key]:
+                self._cancelled.discard(key); state["cancelled"] = True
+        res = {"ok": code == 0 and not state["timeout"] and not state["cancelled"], "code": code,
+               "stdout": out.text(), "stderr": err.text(), "truncated": bool(out.dropped or err.dropped), "bytes": state["bytes"]}
+        if state["timeout"]: res["error"] = f"Превышено время ожидания ({timeout} с)"
+        if state["cancelled"]: res["error"] = "Остановлено пользователем"; res["cancelled"] = True
+        return res
+
+def _kill(proc: asyncio.subprocess.Process):
+    # Процесс запущен в своей сессии — сигнал уходит всей группе (npm, pytest-xdist и т.п. порождают детей)
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError, OSError):
+        return
+    def _force():
+        try: os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError, OSError): pass
+    asyncio.get_running_loop().call_later(5.0, lambda: proc.returncode is None and _force())
+
+runner = ProcessRunner(settings.cmd_max_parallel, settings.cmd_max_per_project)
@@ -1,34 +1,114 @@
-import pathlib
+import pathlib, hashlib, json, datetime, itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sqlmodel import Session, select
-from .models import FileIndex, StepLog
+from .models import FileIndex
 from .llm_client import call_llm
+from .runner_utils import log
+from .retrieval import retriever, CHUNK_CHARS, MAX_CHUNKS_PER_FILE
+from .scanner import iter_files, is_binary
+from .config import settings
+from . import metrics
 
-def index_project(session: Session, project):
+SUFFIXES = (".md",".py",".js",".ts",".php",".json",".yaml",".yml",".txt",".ini",".env",".html",".css")
+MAX_FILES = 400
+TREE_FILES = 200
+WRITE_BATCH = 50
+READ_BLOCK = 65536
+# Сколько текста файла нужно дальше: фрагменты для поиска (retriever) и начало для промпта суммаризации
+TEXT_CHARS = CHUNK_CHARS * MAX_CHUNKS_PER_FILE
+
+def _hash_and_prefix(path: pathlib.Path) -> tuple[str, str]:
+    # Хеш — потоково по всему файлу, в памяти остаётся только начало (UTF-8: до 4 байт на символ)
+    h, head, keep = hashlib.sha256(), bytearray(), TEXT_CHARS * 4
+    try:
+        with open(path, "rb") as f:
+            while block := f.read(READ_BLOCK):
+                h.update(block)
+                if len(head) < keep: head += block[:keep - len(head)]
+    except OSError:
+        pass
+    return h.hexdigest(), head.decode("utf-8", errors="ignore")[:TEXT_CHARS]
+
+def _summary_prompt(root: pathlib.Path, p: pathlib.Path, txt: str) -> str:
+    return f"Суммаризируй файл простыми словами (1-2 абзаца) для пользователя без тех. знаний.\nПуть: {p.relative_to(root)}\n---\n{txt[:4000]}"
+
+@metrics.timed("rag_index")
+def index_project(session: Session, project) -> dict:
+    # Инкрементальная индексация: LLM вызывается только для новых и изменённых файлов
     root = pathlib.Path(project.workspace_path)
-    files = [p for p in root.rglob("*") if p.is_file() and p.suffix in (".md",".py",".js",".ts",".php",".json",".yaml",".yml",".txt",".ini",".env",".html",".css")]
-    for p in files[:400]:
-        try:
-            txt = p.read_text(encoding="utf-8", errors="ignore")
-        except Exception:
-            txt = ""
-        prompt = f"Суммаризируй файл простыми словами (1-2 абзаца) для пользователя без тех. знаний.\nПуть: {p.relative_to(root)}\n---\n{txt[:4000]}"
-        summary = call_llm(prompt)
-        row = session.exec(select(FileIndex).where(FileIndex.project_id==project.id, FileIndex.path==str(p))).first()
-        if not row:
-            row = FileIndex(project_id=project.id, path=str(p), summary=summary)
+    # .agent/ (план, context.md) переписывается каждым шагом — его суммаризировать незачем;
+    # зависимости и всё из .gitignore сканер отсекает, не спускаясь в каталоги
+    files = itertools.islice(iter_files(str(root), SUFFIXES, extra_ignore=(".agent",)), MAX_FILES)
+    rows = {r.path: r for r in session.exec(select(FileIndex).where(FileIndex.project_id==project.id)).all()}
+    stats = {"reused": 0, "summarized": 0, "pruned": 0, "failed": 0}
+    seen = set(); jobs = []
+    for e in files:
+        p = root / e.rel
+        key = str(p)
+        seen.add(key)
+        row = rows.get(key)
+        # mtime и размер совпали — файл не трогали, хеш не пересчитываем
+        if row and row.summary and row.size == e.size and row.mtime == e.mtime:
+            stats["reused"] += 1
+            continue
+        if is_binary(key):
+            continue
+        digest, txt = _hash_and_prefix(p)
+        if row and row.summary and row.content_hash == digest:
+            row.mtime, row.size = e.mtime, e.size
             session.add(row)
-        else:
-            row.summary = summary
-        session.add(StepLog(project_id=project.id, type="rag", role="system", content=f"Indexed {p}"))
+            stats["reused"] += 1
+            continue
+        jobs.append((p, row, digest, e, txt, _summary_prompt(root, p, txt)))
+    summarize_many(session, project, jobs, stats)
+    for key, row in rows.items():
+        if key not in seen:
+            session.delete(row)
+            retriever.remove(project.id, key)
+            stats["pruned"] += 1
     session.commit()
+    for k, v in stats.items(): metrics.count("rag_files_total", v, result=k)
+    log(session, project.id, "rag", f"Индексация: без изменений {stats['reused']}, обновлено {stats['summarized']}, удалено {stats['pruned']}, ошибок {stats['failed']}",
+        meta=json.dumps(stats))
+    return stats
 
+def summarize_many(session: Session, project, jobs: list, stats: dict):
+    # Параллельные запросы к LLM (не больше llm_concurrency одновременно), запись в БД пачками
+    if not jobs: return
+    pending = []
+    with ThreadPoolExecutor(max_workers=max(1, settings.llm_concurrency)) as pool:
+        futures = {pool.submit(metrics.wrap(call_llm), prompt): (p, row, digest, st, txt) for p, row, digest, st, txt, prompt in jobs}
+        for fut in as_completed(futures):
+            p, row, digest, st, txt = futures[fut]
+            try:
+                summary = fut.result()
+            except Exception as e:
+                stats["failed"] += 1
+                log(session, project.id, "error", f"Не удалось описать {p}: {e}")
+                continue
+            if not row:
+                row = FileIndex(project_id=project.id, path=str(p))
+            row.summary = summary; row.content_hash = digest
+            row.mtime, row.size = st.mtime, st.size
+            row.updated_at = datetime.datetime.utcnow()
+            pending.append(row)
+            retriever.update(project.id, str(p), summary, txt)
+            log(session, project.id, "rag", f"Indexed {p}")
+            stats["summarized"] += 1
+            if len(pending) >= WRITE_BATCH:
+                session.add_all(pending); session.commit(); pending = []
+    if pending:
+        session.add_all(pending); session.commit()
+
+@metrics.timed("rag_context")
 def build_context_markdown(session: Session, project):
     root = pathlib.Path(project.workspace_path)
     agent_dir = root / ".agent"; agent_dir.mkdir(exist_ok=True)
-    rows = session.exec(select(FileIndex).where(FileIndex.project_id==project.id)).all()
-    body = ["# Краткое описание файлов (для всех)\n"]
+    rows = session.exec(select(FileIndex).where(FileIndex.project_id==project.id).order_by(FileIndex.path)).all()
+    body = ["# Краткое описание файлов (для всех)\n", "## Структура проекта\n"]
+    body += [f"- {e.rel}" for e in itertools.islice(iter_files(str(root), extra_ignore=(".agent",)), TREE_FILES)]
+    body.append("")
     for r in rows[:200]:
         body.append(f"## {r.path}\n{r.summary}\n")
     (agent_dir / "context.md").write_text("\n".join(body), encoding="utf-8")
-    session.add(StepLog(project_id=project.id, type="explain", role="system", content="Обновлён контекст проекта (.agent/context.md)"))
-    session.commit()
+    log(session, project.id, "explain", "Обновлён контекст проекта (.agent/context.md)")
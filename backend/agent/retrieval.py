@@ -0,0 +1,176 @@
+import re, math, zlib, pathlib, threading
+import numpy as np
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+from sqlmodel import Session, select
+from .models import FileIndex
+from .config import settings
+
+CHUNK_CHARS = 1200
+MAX_CHUNKS_PER_FILE = 24
+DIM = 2048            # размер хеш-пространства для векторов
+BM25_K1, BM25_B = 1.5, 0.75
+_WORD = re.compile(r"[^\W_]+", re.UNICODE)
+_TOKEN = re.compile(r"[^\W_]+|[^\w\s]", re.UNICODE)
+STOPWORDS = set("и в во на с со к по о об от до за из у не ни а но что как это то же ли бы для или the a an and or of to in on for is are be it this that with as by".split())
+
+def terms(text: str) -> List[str]:
+    return [w for w in _WORD.findall(text.lower()) if w not in STOPWORDS]
+
+def estimate_tokens(text: str) -> int:
+    # Оценка числа токенов BPE-токенизатора: слова длиннее ~4 символов режутся на несколько частей
+    return sum(1 + len(t) // 5 for t in _TOKEN.findall(text))
+
+def _vector(words: List[str]) -> np.ndarray:
+    # Hashing vectorizer: униграммы + биграммы, знак из хеша снижает влияние коллизий
+    v = np.zeros(DIM, dtype=np.float32)
+    feats = words + [a + " " + b for a, b in zip(words, words[1:])]
+    for f in feats:
+        h = zlib.crc32(f.encode("utf-8"))
+        v[h % DIM] += 1.0 if (h >> 31) & 1 else -1.0
+    n = np.linalg.norm(v)
+    return v / n if n else v
+
+def _sparse(words: List[str]) -> tuple:
+    # Вектор фрагмента хранится разреженно (ненулевые координаты и значения): во фрагменте в 1200 символов
+    # их сотни, а не DIM — плотный float32 на каждый фрагмент стоил бы 8 КБ
+    v = _vector(words)
+    cols = np.flatnonzero(v).astype(np.uint16)
+    return cols, v[cols]
+
+def chunk_text(text: str) -> List[str]:
+    # Режем по строкам, чтобы фрагмент кода не обрывался посреди строки
+    chunks, cur, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        if size + len(line) > CHUNK_CHARS and cur:
+            chunks.append("".join(cur)); cur, size = [], 0
+            if len(chunks) >= MAX_CHUNKS_PER_FILE: break
+        cur.append(line[:CHUNK_CHARS]); size += min(len(line), CHUNK_CHARS)
+    if cur and len(chunks) < MAX_CHUNKS_PER_FILE: chunks.append("".join(cur))
+    return [c for c in chunks if c.strip()]
+
+class Doc:
+    __slots__ = ("path", "kind", "text", "tf", "length", "cols", "vals", "tokens")
+    def __init__(self, path: str, kind: str, text: str, extra: str = ""):
+        self.path, self.kind, self.text = path, kind, text
+        words = terms(extra + "\n" + text if extra else text)
+        self.tf = Counter(words); self.length = len(words)
+        self.cols, self.vals = _sparse(words)
+        self.tokens = estimate_tokens(text)
+
+# Поисковый индекс одного проекта: BM25 по словам + косинус по хеш-векторам.
+# Обновляется пофайлово, когда rag переиндексирует изменившиеся файлы.
+class ProjectIndex:
+    def __init__(self):
+        self.docs: Dict[str, List[Doc]] = {}
+        self.df: Counter = Counter()
+        self.total_len = 0
+        self.count = 0
+        self._matrix: Optional[tuple] = None   # (строка, столбец, значение) всех фрагментов — для косинуса одним проходом
+        self._flat: List[Doc] = []
+        self._lock = threading.Lock()
+
+    def update(self, path: str, summary: str, text: str):
+        docs = []
+        p = pathlib.Path(path)
+        if summary: docs.append(Doc(path, "summary", summary, extra=f"{p.parent.name} {p.name}"))
+        docs += [Doc(path, "chunk", c) for c in chunk_text(text)]
+        with self._lock:
+            self._drop(path)
+            self.docs[path] = docs
+            for d in docs:
+                self.df.update(d.tf.keys()); self.total_len += d.length; self.count += 1
+            self._matrix = None
+
+    def remove(self, path: str):
+        with self._lock:
+            self._drop(path); self._matrix = None
+
+    def _drop(self, path: str):
+        for d in self.docs.pop(path, []):
+            self.df.subtract(d.tf.keys()); self.total_len -= d.length; self.count -= 1
+
+    def search(self, query: str, k: int) -> List[tuple]:
+        q = terms(query)
+        if not q: return []
+        with self._lock:
+            if self._matrix is None:
+                self._flat = [d for docs in self.docs.values() for d in docs]
+                rows = np.repeat(np.arange(len(self._flat), dtype=np.int32), [len(d.cols) for d in self._flat])
+                cols = np.concatenate([d.cols for d in self._flat]) if self._flat else np.zeros(0, dtype=np.uint16)
+                vals = np.concatenate([d.vals for d in self._flat]) if self._flat else np.zeros(0, dtype=np.float32)
+                self._matrix = (rows, cols, vals)
+            flat, matrix = self._flat, self._matrix
+            if not flat: return []
+            avg = self.total_len / max(1, self.count)
+            idf = {t: math.log(1 + (self.count - self.df[t] + 0.5) / (self.df[t] + 0.5)) for t in set(q)}
+        bm25 = np.zeros(len(flat), dtype=np.float32)
+        for i, d in enumerate(flat):
+            s = 0.0
+            for t, w in idf.items():
+                f = d.tf.get(t)
+                if f: s += w * f * (BM25_K1 + 1) / (f + BM25_K1 * (1 - BM25_B + BM25_B * d.length / avg))
+            bm25[i] = s
+        rows, cols, vals = matrix
+        cos = np.bincount(rows, weights=vals * _vector(q)[cols], minlength=len(flat))
+        top = bm25.max()
+        score = (bm25 / top if top > 0 else bm25) * 0.7 + np.clip(cos, 0, None) * 0.3
+        order = np.argsort(-score)[:k]
+        return [(float(score[i]), flat[i]) for i in order if score[i] > 0]
+
+class Retriever:
+    # Индексы последних settings.rag_index_projects проектов; вытесненный соберётся заново при следующем поиске
+    def __init__(self):
+        self._indexes: "OrderedDict[int, ProjectIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, pid: int) -> Optional[ProjectIndex]:
+        with self._lock:
+            idx = self._indexes.get(pid)
+            if idx is not None: self._indexes.move_to_end(pid)
+            return idx
+
+    def ensure(self, session: Session, project) -> ProjectIndex:
+        # Первое обращение после старта (или после вытеснения): собираем индекс из FileIndex и файлов workspace
+        idx = self._get(project.id)
+        if idx is not None: return idx
+        idx = ProjectIndex()
+        for row in session.exec(select(FileIndex).where(FileIndex.project_id==project.id)).all():
+            idx.update(row.path, row.summary, _read(row.path))
+        with self._lock:
+            idx = self._indexes.setdefault(project.id, idx)
+            self._indexes.move_to_end(project.id)
+            while len(self._indexes) > max(1, settings.rag_index_projects): self._indexes.popitem(last=False)
+            return idx
+
+    def update(self, pid: int, path: str, summary: str, text: str):
+        # Индекс ещё не построен — соберётся целиком при первом поиске
+        idx = self._get(pid)
+        if idx is not None: idx.update(path, summary, text)
+
+    def remove(self, pid: int, path: str):
+        idx = self._get(pid)
+        if idx is not None: idx.remove(path)
+
+    def context_for(self, session: Session, project, query: str, budget_tokens: int | None = None, k: int | None = None) -> str:
+        # Самые релевантные фрагменты, уложенные в бюджет токенов (не больше k штук)
+        budget = settings.rag_context_tokens if budget_tokens is None else budget_tokens
+        hits = self.ensure(session, project).search(query, k or settings.rag_top_k)
+        root = pathlib.Path(project.workspace_path)
+        parts, used = [], 0
+        for _, d in hits:
+            if used + d.tokens > budget: continue
+            try: rel = pathlib.Path(d.path).relative_to(root)
+            except ValueError: rel = d.path
+            parts.append(f"### {rel} ({'описание' if d.kind == 'summary' else 'фрагмент'})\n{d.text}")
+            used += d.tokens
+        return "\n\n".join(parts)
+
+def _read(path: str) -> str:
+    try:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            return f.read(CHUNK_CHARS * MAX_CHUNKS_PER_FILE)
+    except OSError:
+        return ""
+
+retriever = Retriever()
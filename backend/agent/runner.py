@@ -5,8 +5,14 @@ from .tools import write_file, run_cmd
 from .llm_client import call_llm, chat_llm
 from .rag import index_project, build_context_markdown
 from .github import init_repo, new_branch, commit_all, push_current
-from .runner_utils import engine, set_status, log
+from .runner_utils import engine, set_status, log, get_control, set_control
+from .jobs import JobCancelled, JobParked
+from .scheduler import scheduler
+from .retrieval import retriever
+from .memory import history_for, schedule_refresh
+from .test_runner import run_tests
 from .config import settings
+from . import metrics
 
 def bootstrap_project(session: Session, name: str, description: str, tech_stack: str, repo_url: str | None) -> Project:
     root = pathlib.Path(settings.workspace_root); root.mkdir(parents=True, exist_ok=True)
@@ -18,37 +24,120 @@ def bootstrap_project(session: Session, name: str, description: str, tech_stack:
     commit_all(str(wp), "chore: bootstrap project")
     return project
 
-def agent_step(session: Session, pid: int, message: str):
+def checkpoint(session: Session, pid: int, progress: dict | None = None):
+    # Между шагами проверяем Project.control (stop — прерываем, pause — ждём) и окно расписания.
+    # Ожидание не держит воркер: задача паркуется и продолжится с того же места (jobs.resume — по снятию паузы
+    # или открытию окна планировщиком)
+    ctl = get_control(session, pid)
+    if ctl.get("stop"): raise JobCancelled("Остановлено пользователем")
+    state = "paused" if ctl.get("pause") else None if scheduler.window_open(pid) else "sleeping"
+    if not state: return
+    project = session.get(Project, pid); session.refresh(project)
+    if project.status != state:
+        set_status(session, pid, state)
+        if state == "paused": log(session, pid, "explain", "Работа на паузе — продолжу, когда паузу снимут", role="system")
+    raise JobParked("На паузе" if state == "paused" else "Вне окна расписания", {"progress": progress or {}})
+
+def agent_step(session: Session, pid: int, message: str, progress: dict | None = None):
     project = session.get(Project, pid)
     set_status(session, pid, "running")
+    try:
+        with metrics.step(), metrics.span("agent_step"):
+            _agent_step(session, pid, project, message, progress if progress is not None else {})
+    except JobParked:
+        raise
+    except JobCancelled:
+        set_control(session, pid, stop=False)
+        log(session, pid, "explain", "Шаг остановлен по запросу", role="system")
+        set_status(session, pid, "idle")
+        raise
+    except Exception as e:
+        log(session, pid, "error", f"Ошибка шага: {e}")
+        set_status(session, pid, "error")
+        raise
+    set_status(session, pid, "idle")
+
+def _agent_step(session: Session, pid: int, project: Project, message: str, progress: dict):
+    # progress — уже сделанные части шага: после парковки в checkpoint шаг продолжается, а не повторяет вызовы LLM
+    checkpoint(session, pid, progress)
     # Пояснение для нефизтехов
-    explain_prompt = f"Объясни простыми словами, что будет сделано: {message}. Коротко: 1-2 предложения."
-    explanation = call_llm(explain_prompt)
-    log(session, pid, "explain", explanation, role="assistant")
+    if "explained" not in progress:
+        explain_prompt = f"Объясни простыми словами, что будет сделано: {message}. Коротко: 1-2 предложения."
+        explanation = call_llm(explain_prompt)
+        log(session, pid, "explain", explanation, role="assistant")
+        progress["explained"] = True
+        checkpoint(session, pid, progress)
     # План и действия (минимальная демонстрация)
-    plan_prompt = f"""
+    if "plan" not in progress:
+        related = retriever.context_for(session, project, message)
+        plan_prompt = f"""
 Ты агент-помощник. Составь чёткий план (3-7 шагов) и предложи конкретные команды (если нужны).
 Проект: {project.name} (стек: {project.tech_stack})
 Задача: {message}
 """
-    plan = call_llm(plan_prompt)
-    log(session, pid, "plan", plan, role="assistant")
+        if related: plan_prompt += f"Относящиеся к задаче файлы проекта:\n{related}\n"
+        plan = call_llm(plan_prompt)
+        log(session, pid, "plan", plan, role="assistant")
+        progress["plan"] = plan
+        checkpoint(session, pid, progress)
     # Сохраняем план
-    write_file(str(pathlib.Path(project.workspace_path)/".agent"/"plan.txt"), plan, create_dirs=True)
-    state = commit_all(project.workspace_path, "docs: обновлён план")
-    log(session, pid, "commit", state)
+    write_file(str(pathlib.Path(project.workspace_path)/".agent"/"plan.txt"), progress["plan"], create_dirs=True)
+    checkpoint(session, pid, progress)
     # Индексация (краткие описания для всех)
     index_project(session, project); build_context_markdown(session, project)
-    set_status(session, pid, "idle")
+    # Все записи шага (план, context.md) — одним коммитом
+    state = commit_all(project.workspace_path, "docs: обновлены план и контекст")
+    log(session, pid, "commit", state, meta=metrics.step_meta())
 
-def chat_message(session: Session, pid: int, text: str) -> str:
+def index_job(pid: int) -> dict:
+    with Session(engine) as s:
+        project = s.get(Project, pid)
+        stats = index_project(s, project); build_context_markdown(s, project)
+        return stats
+
+def test_job(pid: int, full: bool = False, force: bool = False) -> dict:
+    with Session(engine) as s:
+        project = s.get(Project, pid)
+        _reset_stop(s, pid)
+        return run_tests(project.workspace_path, project.tech_stack, pid=pid, full=full, force=force)
+
+def agent_step_job(pid: int, message: str, progress: dict | None = None):
+    with Session(engine) as s:
+        # после парковки stop уже проверен checkpoint'ом — сбрасываем только при первом запуске
+        if progress is None: _reset_stop(s, pid)
+        agent_step(s, pid, message, progress)
+
+def _reset_stop(session: Session, pid: int):
+    # stop относится к задаче, которая выполнялась в момент запроса; новая задача начинает с чистого флага
+    if get_control(session, pid).get("stop"): set_control(session, pid, stop=False)
+
+def chat_prepare(session: Session, pid: int, text: str) -> tuple[str, list[dict]]:
     project = session.get(Project, pid)
     session.add(ChatMessage(project_id=pid, role="user", content=text)); session.commit()
-    ctx_file = pathlib.Path(project.workspace_path)/".agent"/"context.md"
     system = f"Ты — агент проекта '{project.name}'. Объясняй просто, предлагай действия, добавляй задачи при необходимости."
-    history=[{"role":"user","content":text}]
-    if ctx_file.exists(): system += "\nКонтекст:\n" + ctx_file.read_text(encoding="utf-8")[:4000]
-    reply = chat_llm(system, history)
+    summary, history = history_for(session, pid)
+    if summary: system += "\nО чём говорили раньше:\n" + summary
+    # Вместо первых 4000 символов context.md — фрагменты, релевантные вопросу, в пределах бюджета токенов
+    related = retriever.context_for(session, project, text)
+    if related: system += "\nКонтекст (релевантные файлы проекта):\n" + related
+    return system, history
+
+def chat_finish(session: Session, pid: int, reply: str) -> str:
     session.add(ChatMessage(project_id=pid, role="assistant", content=reply)); session.commit()
     log(session, pid, "chat", reply, role="assistant")
+    # Сводка обновляется в фоне — ответ (и done в WebSocket) её не ждёт
+    schedule_refresh(pid)
     return reply
+
+def chat_message(session: Session, pid: int, text: str) -> str:
+    system, history = chat_prepare(session, pid, text)
+    return chat_finish(session, pid, chat_llm(system, history))
+
+def chat_prepare_job(pid: int, text: str) -> tuple[str, list[dict]] | None:
+    with Session(engine) as s:
+        if not s.get(Project, pid): return None
+        return chat_prepare(s, pid, text)
+
+def chat_finish_job(pid: int, reply: str) -> str:
+    with Session(engine) as s:
+        return chat_finish(s, pid, reply)
@@ -1,35 +1,157 @@
-import json, datetime, pytz, pathlib
-from sqlmodel import SQLModel, Session, create_engine, select
-from .models import Project, StepLog, WorkSchedule
+import json, datetime, pytz, pathlib, threading, atexit, logging
+from sqlalchemy import insert, update, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+from .models import Project, StepLog, IdSequence
+from .db import engine
+from .events import broker
 from .config import settings
+from . import metrics
 
-DB_PATH = pathlib.Path("state.db")
-engine = create_engine(f"sqlite:///{DB_PATH}", echo=False)
-SQLModel.metadata.create_all(engine)
+def _row_event(row: dict) -> dict:
+    return {"event": "log", "id": row["id"], "data": {"id": row["id"], "ts": row["ts"].isoformat(), "type": row["type"], "role": row["role"], "content": row["content"]}}
 
-def _now_local(tz):
-    return datetime.datetime.now(tz)
+def log_event(entry) -> dict:
+    if isinstance(entry, dict): return _row_event(entry)
+    return _row_event({"id": entry.id, "ts": entry.ts, "type": entry.type, "role": entry.role, "content": entry.content})
 
-def within_window(ws: WorkSchedule, tz) -> bool:
-    if not ws or not ws.enabled: return True
-    now = _now_local(tz)
-    day = now.strftime("%a")
-    if day not in ws.days.split(","): return False
-    try:
-        start_s, end_s = ws.time_window.split("-")
-        sh, sm = map(int, start_s.split(":"))
-        eh, em = map(int, end_s.split(":"))
-    except Exception:
-        return True
-    start = now.replace(hour=sh, minute=sm, second=0, microsecond=0)
-    end = now.replace(hour=eh, minute=em, second=0, microsecond=0)
-    if start <= end:
-        return start <= now <= end
-    return now >= start or now <= end
+# Буферизованная запись StepLog: строки копятся в памяти и вставляются одной транзакцией
+# по размеру пачки или по таймеру. id выдаются сразу — блоками из таблицы IdSequence, поэтому
+# несколько процессов (или Postgres с несколькими воркерами) не пересекаются. Событие уходит
+# подписчикам /stream под той же блокировкой, что выдаёт id, — в порядке id.
+# Все StepLog пишутся только через log()/log_writer — иначе id разойдутся с выданными блоками.
+ID_BLOCK = 100
+MAX_ATTEMPTS = 3
+_logger = logging.getLogger("agent.log_writer")
+
+class LogWriter:
+    def __init__(self, engine, batch_size: int, interval: float):
+        self.engine, self.batch_size, self.interval = engine, batch_size, interval
+        self._buf: list[dict] = []
+        self._inflight: list[dict] = []
+        self._retry: list[dict] = []     # пачка, не вставленная с прошлой попытки
+        self._attempts = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()   # вставки строго по одной — пачки коммитятся в порядке id
+        self._next_id = self._block_end = 0
+        self._thread = None
+        self._closed = False
+        self.flushes = 0
+        self.dropped = 0
+
+    def _allocate(self, n: int) -> int:
+        # UPDATE блокирует строку счётчика (в SQLite — всю БД на запись), так что блоки у процессов не пересекаются
+        seq = IdSequence.__table__
+        for _ in range(5):
+            try:
+                with self.engine.begin() as conn:
+                    res = conn.execute(update(seq).where(seq.c.name == "steplog").values(next_id=seq.c.next_id + n))
+                    if res.rowcount:
+                        return conn.execute(select(seq.c.next_id).where(seq.c.name == "steplog")).scalar_one() - n
+                    start = (conn.execute(select(func.max(StepLog.id))).scalar() or 0) + 1
+                    conn.execute(insert(seq).values(name="steplog", next_id=start + n))
+                    return start
+            except IntegrityError:
+                continue   # счётчик одновременно создал другой процесс — повторяем через UPDATE
+        raise RuntimeError("Не удалось выделить id для StepLog")
+
+    def write(self, pid: int, type_: str, content: str, role: str = "system", meta: str = "") -> dict:
+        with self._cond:
+            if self._next_id >= self._block_end:
+                self._next_id = self._allocate(ID_BLOCK); self._block_end = self._next_id + ID_BLOCK
+            row = {"id": self._next_id, "project_id": pid, "ts": datetime.datetime.utcnow(), "role": role, "type": type_, "content": content, "meta": meta}
+            self._next_id += 1
+            self._buf.append(row)
+            # publish не блокирует (очередь/call_soon_threadsafe) — делаем под lock, чтобы порядок событий совпадал с id
+            broker.publish(pid, _row_event(row))
+            if not self._closed:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True); self._thread.start()
+                if len(self._buf) >= self.batch_size: self._cond.notify()
+            closed = self._closed
+        if closed: self.flush()
+        return row
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._closed: return
+                self._cond.wait(self.interval)
+            self.flush()
+
+    def _insert(self, rows: list[dict]) -> Exception | None:
+        try:
+            with metrics.span("db_flush"), self.engine.begin() as conn:
+                conn.execute(insert(StepLog.__table__), rows)
+            metrics.count("db_rows_total", len(rows), table="steplog")
+            return None
+        except Exception as e:
+            _logger.warning("Не удалось записать %d строк StepLog: %s", len(rows), getattr(e, "orig", None) or e)
+            return e
+
+    def _salvage(self, rows: list[dict]):
+        # Конфликт ключа или MAX_ATTEMPTS неудач подряд: пишем построчно, то, что не встаёт (конфликт ключа и т.п.), выбрасываем
+        for row in rows:
+            if self._insert([row]) is not None:
+                self.dropped += 1
+                _logger.error("Строка StepLog id=%s (проект %s) отброшена", row["id"], row["project_id"])
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                rows = self._retry + self._buf
+                if not rows: return
+                self._buf, self._retry = [], []
+                self._inflight = rows
+            # Вставка идёт без удержания _cond: писатели не ждут диск
+            err = self._insert(rows)
+            ok = err is None
+            if not ok:
+                self._attempts += 1
+                # Повтор не поможет при нарушении ограничений; при недоступной БД — ограниченное число попыток
+                if isinstance(err, IntegrityError) or self._attempts >= MAX_ATTEMPTS:
+                    self._salvage(rows); ok = True
+            with self._cond:
+                self._inflight = []
+                if ok:
+                    self._attempts = 0; self.flushes += 1
+                else:
+                    self._retry = rows   # БД занята/недоступна — повторим на следующем тике
+
+    def pending(self, pid: int, after_id: int | None = None) -> list[dict]:
+        # Ещё не записанные в БД строки — для догонки SSE-клиентов по курсору
+        with self._cond:
+            rows = self._inflight + self._retry + self._buf
+            return [r for r in rows if r["project_id"] == pid and (after_id is None or r["id"] > after_id)]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None: self._thread.join(timeout=5)
+        self.flush()
+
+log_writer = LogWriter(engine, settings.log_batch_size, settings.log_flush_ms / 1000)
+atexit.register(log_writer.close)
 
 def set_status(session: Session, pid: int, status: str):
-    p = session.get(Project, pid); p.status = status; session.add(p); session.commit()
+    with metrics.span("db_commit"):
+        p = session.get(Project, pid); p.status = status; session.add(p); session.commit()
+
+def get_control(session: Session, pid: int) -> dict:
+    p = session.get(Project, pid)
+    session.refresh(p)
+    try:
+        return json.loads(p.control) if p.control else {}
+    except ValueError:
+        return {}
+
+def set_control(session: Session, pid: int, **flags) -> dict:
+    ctl = get_control(session, pid)
+    ctl.update({k: v for k, v in flags.items() if v is not None})
+    p = session.get(Project, pid); p.control = json.dumps(ctl); session.add(p); session.commit()
+    return ctl
 
-def log(session: Session, pid: int, type_: str, content: str, role: str = "system"):
-    entry = StepLog(project_id=pid, type=type_, content=content, role=role)
-    session.add(entry); session.commit()
+def log(session: Session | None, pid: int, type_: str, content: str, role: str = "system", meta: str = "") -> dict:
+    # session оставлен для совместимости: запись идёт через общий буфер log_writer
+    return log_writer.write(pid, type_, content, role=role, meta=meta)
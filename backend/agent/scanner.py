@@ -0,0 +1,123 @@
+import os, re
+from typing import Iterator, List, Optional, Tuple
+from .config import settings
+
+# Каталоги, в которые не спускаемся никогда: зависимости, сборка, кеши, служебное
+DEFAULT_IGNORE_DIRS = {".git", ".hg", ".svn", "node_modules", "vendor", "__pycache__", ".venv", "venv", "env",
+                       "dist", "build", ".next", ".nuxt", ".cache", ".idea", ".vscode", ".mypy_cache",
+                       ".pytest_cache", ".ruff_cache", ".tox", ".nox", "coverage", ".gradle", "target"}
+BINARY_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".pdf", ".zip", ".gz", ".tar", ".tgz", ".7z",
+                   ".so", ".dll", ".exe", ".bin", ".pyc", ".class", ".jar", ".woff", ".woff2", ".ttf", ".mp3", ".mp4",
+                   ".sqlite", ".db", ".lock"}
+PROBE_BYTES = 8192
+
+class ScanEntry:
+    __slots__ = ("path", "rel", "size", "mtime")
+    def __init__(self, path: str, rel: str, size: int, mtime: float):
+        self.path, self.rel, self.size, self.mtime = path, rel, size, mtime
+
+def _glob_to_regex(pat: str) -> str:
+    out, i = [], 0
+    while i < len(pat):
+        c = pat[i]
+        if pat.startswith("**/", i): out.append("(?:.*/)?"); i += 3; continue
+        if pat.startswith("/**", i) and i + 3 == len(pat): out.append("/.*"); i += 3; continue
+        if pat.startswith("**", i): out.append(".*"); i += 2; continue
+        if c == "*": out.append("[^/]*")
+        elif c == "?": out.append("[^/]")
+        elif c == "[":
+            j = pat.find("]", i + 1)
+            if j == -1: out.append(re.escape(c))
+            else: out.append(pat[i:j + 1].replace("[!", "[^")); i = j
+        else: out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+# Подмножество синтаксиса .gitignore: комментарии, !отрицание, /якорь, dir/, *, **, ?, [..]
+class IgnoreRules:
+    def __init__(self):
+        self.rules: List[Tuple[re.Pattern, bool, bool]] = []   # (regex, negate, dir_only)
+
+    def add_file(self, gitignore: str, base: str = ""):
+        try:
+            with open(gitignore, "r", encoding="utf-8", errors="ignore") as f: lines = f.read().splitlines()
+        except OSError:
+            return
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith("#"): continue
+            negate = line.startswith("!")
+            if negate: line = line[1:]
+            dir_only = line.endswith("/")
+            # Снимаем только завершающий "/": ведущий делает шаблон привязанным к каталогу .gitignore
+            line = line.rstrip("/")
+            anchored = line.startswith("/") or "/" in line
+            line = line.lstrip("/")
+            prefix = (re.escape(base) + "/") if base else ""
+            rx = prefix + ("" if anchored else "(?:.*/)?") + _glob_to_regex(line) + "$"
+            self.rules.append((re.compile(rx), negate, dir_only))
+
+    def ignored(self, rel: str, is_dir: bool) -> bool:
+        hit = False
+        for rx, negate, dir_only in self.rules:
+            if dir_only and not is_dir: continue
+            if rx.match(rel): hit = not negate
+        return hit
+
+def is_binary(path: str) -> bool:
+    if os.path.splitext(path)[1].lower() in BINARY_SUFFIXES: return True
+    return b"\0" in read_prefix(path, PROBE_BYTES)
+
+def read_prefix(path: str, limit: int) -> bytes:
+    # Ограниченное чтение: большие файлы целиком в память не поднимаем
+    try:
+        with open(path, "rb") as f: return f.read(limit)
+    except OSError:
+        return b""
+
+def iter_files(root: str, suffixes: Optional[tuple] = None, max_size: Optional[int] = None,
+               extra_ignore: tuple = (), use_gitignore: bool = True) -> Iterator[ScanEntry]:
+    # Ленивый обход через os.scandir: игнорируемые каталоги отсекаются до спуска,
+    # поэтому время и память не зависят от размера node_modules/vendor
+    max_size = settings.scan_max_file_bytes if max_size is None else max_size
+    skip = DEFAULT_IGNORE_DIRS | set(extra_ignore)
+    rules = IgnoreRules()
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        abs_dir = os.path.join(root, rel_dir) if rel_dir else root
+        if use_gitignore: rules.add_file(os.path.join(abs_dir, ".gitignore"), rel_dir)
+        try:
+            with os.scandir(abs_dir) as it: entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for e in entries:
+            rel = f"{rel_dir}/{e.name}" if rel_dir else e.name
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    if e.name not in skip and not rules.ignored(rel, True): subdirs.append(rel)
+                    continue
+                if not e.is_file(follow_symlinks=False): continue
+            except OSError:
+                continue
+            if suffixes is not None and os.path.splitext(e.name)[1] not in suffixes: continue
+            if rules.ignored(rel, False): continue
+            try: st = e.stat()
+            except OSError: continue
+            if st.st_size > max_size: continue
+            yield ScanEntry(e.path, rel, st.st_size, st.st_mtime)
+        stack.extend(reversed(subdirs))   # обход в глубину в алфавитном порядке
+
+def list_entries(path: str, limit: int = 1000) -> Tuple[List[dict], bool]:
+    # Содержимое одного каталога: тип берём из d_type (без stat), stat только для размера файлов
+    items = []
+    with os.scandir(path) as it:
+        for e in it:
+            if len(items) >= limit: return items, True
+            try:
+                is_dir = e.is_dir()
+                items.append({"name": e.name, "is_dir": is_dir, "size": 0 if is_dir else e.stat().st_size})
+            except OSError:
+                continue
+    return items, False
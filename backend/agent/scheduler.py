@@ -1,24 +1,142 @@
-import asyncio, pytz, datetime
+import asyncio, pytz, datetime, heapq, threading
+from typing import Dict, List, Optional, Set
+from sqlalchemy import update
 from sqlmodel import Session, select
 from .config import settings
-from .models import Project, WorkSchedule, StepLog
-from .runner_utils import within_window, set_status, log
+from .models import Project, WorkSchedule
+from .runner_utils import log
+from .jobs import jobs
 
-async def schedule_loop(engine):
-    tz = pytz.timezone(settings.timezone)
-    while True:
+DAYS = ("Mon","Tue","Wed","Thu","Fri","Sat","Sun")
+
+# Расписание, разобранное один раз: правило окна (дни + интервал, в т.ч. через полночь) и расчёт ближайшей смены окна
+class Window:
+    def __init__(self, ws: WorkSchedule, tz):
+        self.tz = tz
+        self.enabled = bool(ws and ws.enabled)
+        self.days = set((ws.days or "").split(",")) if ws else set(DAYS)
+        self.start = self.end = None
+        try:
+            start_s, end_s = ws.time_window.split("-")
+            self.start = tuple(map(int, start_s.split(":")))
+            self.end = tuple(map(int, end_s.split(":")))
+        except Exception:
+            self.start = self.end = None   # непарсящееся окно — ограничены только дни
+
+    def is_open(self, now: datetime.datetime) -> bool:
+        if not self.enabled: return True
+        if now.strftime("%a") not in self.days: return False
+        if self.start is None: return True
+        start = now.replace(hour=self.start[0], minute=self.start[1], second=0, microsecond=0)
+        end = now.replace(hour=self.end[0], minute=self.end[1], second=0, microsecond=0)
+        if start <= end:
+            return start <= now <= end
+        return now >= start or now <= end
+
+    def next_transition(self, now: datetime.datetime) -> Optional[datetime.datetime]:
+        # Состояние меняется только на границах: начало окна, конец окна (включительно) и полночь (смена дня недели)
+        if not self.enabled: return None
+        state = self.is_open(now)
+        candidates = []
+        for d in range(9):
+            day = now.date() + datetime.timedelta(days=d)
+            bounds = [((0, 0), 0)] if self.start is None else [(self.start, 0), (self.end, 1), ((0, 0), 0)]
+            for hm, shift in bounds:
+                naive = datetime.datetime.combine(day, datetime.time(hm[0], hm[1])) + datetime.timedelta(seconds=shift)
+                at = self.tz.localize(naive)
+                if at > now: candidates.append(at)
+        for at in sorted(candidates):
+            if self.is_open(at) != state: return at
+        return None
+
+# Планировщик на событиях: куча ближайших переходов, сон ровно до следующей границы,
+# пересчёт проекта при изменении его расписания
+class Scheduler:
+    def __init__(self):
+        self.tz = pytz.timezone(settings.timezone)
+        self._windows: Dict[int, Window] = {}
+        self._heap: List[tuple] = []
+        self._versions: Dict[int, int] = {}
+        self._dirty: Set[int] = set()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    def window_open(self, pid: int) -> bool:
+        w = self._windows.get(pid)
+        return w.is_open(datetime.datetime.now(self.tz)) if w else True
+
+    def invalidate(self, pid: int):
+        # Зовётся из обработчиков API (в потоке) — будим цикл через call_soon_threadsafe
+        with self._lock: self._dirty.add(pid)
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _schedule(self, pid: int, now: datetime.datetime):
+        self._versions[pid] = self._versions.get(pid, 0) + 1
+        w = self._windows.get(pid)
+        at = w.next_transition(now) if w else None
+        if at: heapq.heappush(self._heap, (at, pid, self._versions[pid]))
+
+    def _reload(self, engine, pids: Optional[Set[int]]) -> Set[int]:
+        # Одним запросом для всех (или только изменившихся) проектов — без N+1
+        with Session(engine) as s:
+            q = select(WorkSchedule)
+            if pids is not None: q = q.where(WorkSchedule.project_id.in_(pids))
+            rows = s.exec(q).all()
+        loaded = {r.project_id: Window(r, self.tz) for r in rows}
+        for pid in (pids if pids is not None else set(self._windows) | set(loaded)):
+            if pid in loaded: self._windows[pid] = loaded[pid]
+            else: self._windows.pop(pid, None)
+        return set(loaded) if pids is None else pids
+
+    def _apply(self, engine, pids: Set[int], now: datetime.datetime):
+        # Все переходы в момент границы — одним UPDATE на направление и одним коммитом
+        closed = [pid for pid in pids if not self.window_open(pid)]
+        opened = [pid for pid in pids if self.window_open(pid)]
+        with Session(engine) as s:
+            to_sleep = s.exec(select(Project.id).where(Project.id.in_(closed), Project.status == "running")).all() if closed else []
+            to_wake = s.exec(select(Project.id).where(Project.id.in_(opened), Project.status == "sleeping")).all() if opened else []
+            if to_sleep: s.exec(update(Project).where(Project.id.in_(to_sleep)).values(status="sleeping"))
+            if to_wake: s.exec(update(Project).where(Project.id.in_(to_wake)).values(status="idle"))
+            s.commit()
+        for pid in to_sleep: log(None, pid, "explain", "Выполнение приостановлено по расписанию (ночной режим)", role="system")
+        for pid in to_wake: log(None, pid, "explain", "Разрешённый интервал: можно продолжить работу", role="system")
+        # Шаги, запаркованные до открытия окна, — обратно в пул воркеров
+        for pid in opened: jobs.resume(pid)
+
+    async def run(self, engine):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        now = datetime.datetime.now(self.tz)
         try:
-            with Session(engine) as s:
-                projects = s.exec(select(Project)).all()
-                for p in projects:
-                    ws = s.exec(select(WorkSchedule).where(WorkSchedule.project_id==p.id)).first()
-                    ok = within_window(ws, tz) if ws else True
-                    if not ok and p.status == "running":
-                        set_status(s, p.id, "sleeping")
-                        log(s, p.id, "explain", "Выполнение приостановлено по расписанию (ночной режим)", role="system")
-                    if ok and p.status == "sleeping":
-                        set_status(s, p.id, "idle")
-                        log(s, p.id, "explain", "Разрешённый интервал: можно продолжить работу", role="system")
+            for pid in self._reload(engine, None): self._schedule(pid, now)
+            self._apply(engine, set(self._windows), now)
         except Exception:
             pass
-        await asyncio.sleep(30)
+        while True:
+            timeout = None
+            if self._heap:
+                timeout = max(0.0, (self._heap[0][0] - datetime.datetime.now(self.tz)).total_seconds())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            now = datetime.datetime.now(self.tz)
+            due: Set[int] = set()
+            while self._heap and self._heap[0][0] <= now:
+                at, pid, version = heapq.heappop(self._heap)
+                if self._versions.get(pid) == version: due.add(pid)
+            with self._lock: dirty, self._dirty = self._dirty, set()
+            try:
+                if dirty: self._reload(engine, dirty)
+                for pid in due | dirty: self._schedule(pid, now)
+                if due | dirty: self._apply(engine, due | dirty, now)
+            except Exception:
+                pass
+
+scheduler = Scheduler()
+
+async def schedule_loop(engine):
+    await scheduler.run(engine)
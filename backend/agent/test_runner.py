@@ -1,15 +1,188 @@
+import json, pathlib, re, shlex, time
+from typing import Dict, List, Optional
 from .tools import run_cmd
+from .scanner import iter_files, read_prefix
+from .github import tree_hash, changed_between
+from .runner_utils import log
+from .config import settings
 
-def detect_runner(tech_stack: str):
+STATE_FILE = pathlib.Path(".agent") / "test_cache.json"
+KEEP_RESULTS = 20
+MAX_FAILURES = 20
+# Изменения этих файлов затрагивают все тесты — только полный прогон
+PY_CONFIG = {"conftest.py", "pytest.ini", "pyproject.toml", "setup.cfg", "setup.py", "tox.ini", "requirements.txt"}
+JS_CONFIG = {"package.json", "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "babel.config.js", ".babelrc", "tsconfig.json"}
+PHP_CONFIG = {"composer.json", "composer.lock", "phpunit.xml", "phpunit.xml.dist", ".env.testing"}
+JS_SUFFIXES = (".js", ".jsx", ".ts", ".tsx", ".mjs", ".cjs", ".vue")
+
+def detect_runner(tech_stack: str, cwd: str | None = None):
+    # Вместо "a || b" (run_cmd не запускает shell) выбираем вариант по тому, что реально установлено в проекте
     s = (tech_stack or "").lower()
+    wp = pathlib.Path(cwd) if cwd else None
     if "laravel" in s or "php" in s:
-        return ("phpunit", "vendor/bin/phpunit || php artisan test --testdox")
+        if wp is None or (wp / "vendor" / "bin" / "phpunit").exists(): return ("phpunit", "php vendor/bin/phpunit")
+        return ("phpunit", "php artisan test")
     if "react" in s or "vite" in s or "jest" in s or "js" in s or "ts" in s:
-        return ("jest", "npm test -- --watchAll=false || npx jest --ci --reporters=default")
+        if wp is None or (wp / "node_modules" / "jest" / "bin" / "jest.js").exists(): return ("jest", "node node_modules/jest/bin/jest.js --ci")
+        return ("jest", "npm test -- --watchAll=false")
     if "python" in s:
-        return ("pytest", "pytest --maxfail=1 -q")
-    return ("generic", "echo 'no tests configured'")
+        return ("pytest", "pytest -q -rfE")
+    return ("generic", "")
+
+def _is_py_test(name: str) -> bool:
+    return name.endswith(".py") and (name.startswith("test_") or name.endswith("_test.py"))
+
+def _select_pytest(cwd: str, changed: List[str]) -> Optional[List[str]]:
+    tests, stems = set(), set()
+    for f in changed:
+        p = pathlib.PurePosixPath(f)
+        if p.name in PY_CONFIG: return None
+        if p.suffix != ".py": continue
+        if _is_py_test(p.name):
+            if (pathlib.Path(cwd) / f).exists(): tests.add(f)
+        elif p.stem != "__init__":
+            stems.add(p.stem)
+    if stems:
+        # Тест модуля foo — test_foo.py / foo_test.py или любой тест, импортирующий foo
+        imports = re.compile(r"^\s*(?:from|import)\s.*\b(?:" + "|".join(map(re.escape, sorted(stems))) + r")\b", re.M)
+        for e in iter_files(cwd, (".py",)):
+            name = pathlib.PurePosixPath(e.rel).name
+            if not _is_py_test(name) or e.rel in tests: continue
+            stem = name[5:-3] if name.startswith("test_") else name[:-8]
+            if stem in stems or imports.search(read_prefix(e.path, 65536).decode("utf-8", "ignore")): tests.add(e.rel)
+    return sorted(tests)
+
+def _select_jest(cwd: str, changed: List[str]) -> Optional[List[str]]:
+    files = []
+    for f in changed:
+        p = pathlib.PurePosixPath(f)
+        if p.name in JS_CONFIG or p.name.startswith("jest.config"): return None
+        if p.suffix in JS_SUFFIXES and (pathlib.Path(cwd) / f).exists(): files.append(f)
+    return files
+
+def _select_phpunit(cwd: str, changed: List[str]) -> Optional[List[str]]:
+    classes = set()
+    for f in changed:
+        p = pathlib.PurePosixPath(f)
+        if p.name in PHP_CONFIG: return None
+        if p.suffix == ".php" and not p.name.endswith(".blade.php"):
+            classes.add(p.stem if p.stem.endswith("Test") else p.stem + "Test")
+    if not classes: return []
+    return sorted(e.rel for e in iter_files(cwd, (".php",)) if pathlib.PurePosixPath(e.rel).stem in classes)
+
+def _select_args(name: str, cmd: str, selected: List[str]) -> str:
+    if name == "pytest": return " ".join(shlex.quote(t) for t in selected)
+    if name == "jest": return "--findRelatedTests " + " ".join(shlex.quote(t) for t in selected)
+    classes = sorted({pathlib.PurePosixPath(t).stem for t in selected})
+    return "--filter " + shlex.quote("(" + "|".join(classes) + ")")
+
+_xdist: Dict[str, bool] = {}
+
+def _worker_args(name: str, cmd: str, cwd: str) -> str:
+    n = settings.test_workers
+    if n <= 0: return ""
+    if name == "pytest":
+        if cwd not in _xdist: _xdist[cwd] = run_cmd('python -c "import xdist"', cwd=cwd, timeout=60).get("ok", False)
+        return f"-n {n}" if _xdist[cwd] else ""
+    if name == "jest" and "jest.js" in cmd: return f"--maxWorkers={n}"
+    return ""
+
+def parse_output(name: str, text: str) -> dict:
+    rep = {"passed": 0, "failed": 0, "skipped": 0, "errors": 0, "failures": []}
+    lines = text.splitlines()
+    counts = re.compile(r"(\d+) (passed|failed|skipped|errors?|pending|todo)")
+    if name == "pytest":
+        summary = [l for l in lines if counts.search(l) and re.search(r" in [\d.]+s", l)]
+        failures = [m.group(1) for m in (re.match(r"^(?:FAILED|ERROR) (\S+)", l) for l in lines) if m]
+    elif name == "jest":
+        summary = [l for l in lines if l.startswith("Tests:")]
+        failures = [m.group(1).strip() for m in (re.match(r"^\s+● (.+)$", l) for l in lines) if m and not m.group(1).startswith("Console")]
+    else:
+        summary = [l for l in lines if re.match(r"^\s*Tests:", l)]
+        failures = [m.group(1) for m in (re.match(r"^\s*(?:\d+\)|FAILED|⨯)\s+(.+)$", l) for l in lines) if m]
+        ok_line = next((m for m in (re.search(r"OK \((\d+) tests?", l) for l in lines) if m), None)
+        if ok_line: rep["passed"] = int(ok_line.group(1))
+        php = next((l for l in lines if re.match(r"^Tests: \d+, Assertions", l)), None)
+        if php:
+            # PHPUnit: "Tests: 5, Assertions: 9, Failures: 1, Errors: 0, Skipped: 1."
+            nums = {k.lower(): int(v) for k, v in re.findall(r"(\w+): (\d+)", php)}
+            rep["failed"], rep["errors"], rep["skipped"] = nums.get("failures", 0), nums.get("errors", 0), nums.get("skipped", 0)
+            rep["passed"] = nums.get("tests", 0) - rep["failed"] - rep["errors"] - rep["skipped"]
+            summary = []
+    if summary:
+        for num, kind in counts.findall(summary[-1]):
+            key = "errors" if kind.startswith("error") else "skipped" if kind in ("pending", "todo") else kind
+            rep[key] += int(num)
+    seen = []
+    for f in failures:
+        if f not in seen: seen.append(f)
+    rep["failures"] = seen[:MAX_FAILURES]
+    return rep
+
+def _load_state(cwd: str, name: str) -> dict:
+    try:
+        state = json.loads((pathlib.Path(cwd) / STATE_FILE).read_text(encoding="utf-8"))
+        if state.get("runner") == name: return state
+    except (OSError, ValueError):
+        pass
+    return {"runner": name, "last_green": None, "runs_since_full": 0, "results": {}}
+
+def _save_state(cwd: str, state: dict):
+    results = state["results"]
+    for key in list(results)[:-KEEP_RESULTS]: results.pop(key)
+    p = pathlib.Path(cwd) / STATE_FILE
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+
+def _describe(rep: dict) -> str:
+    mode = {"full": "полный прогон", "incremental": f"выборочно: {len(rep.get('selected', []))} шт.",
+            "cached": "из кеша, код не менялся", "skipped": "не запускались"}[rep["mode"]]
+    text = f"Тесты ({rep['runner']}, {mode}): {'успешно' if rep['ok'] else 'есть ошибки'}"
+    if rep.get("note"): text += f" — {rep['note']}"
+    if rep["mode"] != "skipped":
+        text += f"\nпройдено {rep.get('passed', 0)}, упало {rep.get('failed', 0)}, ошибок {rep.get('errors', 0)}, пропущено {rep.get('skipped', 0)}"
+        if rep.get("duration") is not None: text += f" за {rep['duration']} с"
+    if rep.get("failures"): text += "\n" + "\n".join("• " + f for f in rep["failures"])
+    return text
+
+def _report(pid: int | None, rep: dict) -> dict:
+    if pid is not None: log(None, pid, "test_report", _describe(rep), meta=json.dumps(rep, ensure_ascii=False))
+    return rep
+
+def run_tests(cwd: str, tech_stack: str, pid: int | None = None, full: bool = False, force: bool = False) -> dict:
+    # Зелёный результат кешируется по хешу дерева рабочей копии (force — прогнать заново); без full запускаются
+    # только тесты, затронутые изменениями с последнего зелёного дерева, полный прогон — раз в TEST_FULL_EVERY запусков
+    name, cmd = detect_runner(tech_stack, cwd)
+    if not cmd: return _report(pid, {"runner": name, "mode": "skipped", "ok": True, "note": "тесты не настроены"})
+    state = _load_state(cwd, name)
+    tree = tree_hash(cwd)
+    cached = state["results"].get(tree) if tree and not force else None
+    if cached and (cached["mode"] == "full" or not full):
+        return _report(pid, dict(cached, mode="cached", cached_mode=cached["mode"]))
+
+    selected = None
+    if not full and tree and state["last_green"] and state["runs_since_full"] + 1 < settings.test_full_every:
+        changed = changed_between(cwd, state["last_green"], tree)
+        if changed is not None:
+            if name == "jest" and "jest.js" not in cmd: selected = None   # npm test: выборка недоступна
+            else: selected = {"pytest": _select_pytest, "jest": _select_jest, "phpunit": _select_phpunit}[name](cwd, changed)
+    mode = "full" if selected is None else "incremental"
+    state["runs_since_full"] = 0 if mode == "full" else state["runs_since_full"] + 1
+    if selected == []:
+        rep = {"runner": name, "mode": "skipped", "ok": True, "tree": tree, "note": "изменения не затрагивают тесты"}
+        state["last_green"] = tree; _save_state(cwd, state)
+        return _report(pid, rep)
 
-def run_tests(cwd: str, tech_stack: str):
-    name, cmd = detect_runner(tech_stack)
-    return run_cmd(cmd, cwd=cwd)
+    full_cmd = " ".join(x for x in (cmd, _worker_args(name, cmd, cwd), _select_args(name, cmd, selected) if selected else "") if x)
+    started = time.monotonic()
+    res = run_cmd(full_cmd, cwd=cwd, timeout=settings.test_timeout, pid=pid)
+    rep = parse_output(name, res.get("stdout", "") + "\n" + res.get("stderr", ""))
+    # pytest: код 5 — тесты не найдены, это не ошибка
+    ok = res["ok"] or (name == "pytest" and res.get("code") == 5)
+    rep.update({"runner": name, "mode": mode, "ok": ok, "code": res.get("code"), "cmd": full_cmd, "tree": tree,
+                "duration": round(time.monotonic() - started, 2), "selected": (selected or [])[:50]})
+    if res.get("error") and not ok: rep["note"] = res["error"]
+    if tree and ok:   # падения не кешируем: они бывают нестабильными, повторный запуск должен их перепроверить
+        state["results"][tree] = rep; state["last_green"] = tree
+    _save_state(cwd, state)
+    return _report(pid, rep)
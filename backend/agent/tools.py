@@ -1,6 +1,12 @@
-import subprocess, os, json, pathlib, shlex
+import os, json, pathlib, shlex
 from typing import Any, Dict
+from sqlmodel import Session
 from .config import settings
+from .scanner import list_entries
+from .events import broker
+from .proc import runner
+from .runner_utils import engine, log, get_control
+from . import metrics
 
 ALLOWED = ("git","pip","python","pytest","npm","pnpm","yarn","composer","php","node")
 
@@ -18,21 +24,46 @@ def read_file(path: str) -> Dict[str, Any]:
     p = pathlib.Path(path)
     return {"ok": p.exists(), "path": str(p), "content": p.read_text(encoding="utf-8") if p.exists() else ""}
 
-def list_dir(path: str) -> Dict[str, Any]:
+def list_dir(path: str, limit: int = 1000) -> Dict[str, Any]:
     p = pathlib.Path(path)
     if not p.exists(): return {"ok": False, "error": "Путь не существует"}
-    items=[{"name":x.name,"is_dir":x.is_dir(),"size":x.stat().st_size} for x in p.iterdir()]
-    return {"ok": True, "items": items}
+    items, truncated = list_entries(str(p), limit)
+    return {"ok": True, "items": items, "truncated": truncated}
 
-def run_cmd(cmd: str, cwd: str | None = None, timeout: int = 900) -> Dict[str, Any]:
+def run_cmd(cmd: str, cwd: str | None = None, timeout: int = 900, pid: int | None = None) -> Dict[str, Any]:
+    # Процесс идёт в общем asyncio-раннере (лимиты: глобальный и на проект). С pid строки вывода
+    # сразу уходят подписчикам /stream, итог (начало + хвост) пишется в лог, stop в Project.control убивает процесс.
     parts = shlex.split(cmd)
     if not parts or parts[0] not in ALLOWED:
         return {"ok": False, "error": f"Команда '{parts[0] if parts else ''}' не разрешена"}
-    try:
-        res = subprocess.run(parts, cwd=cwd, capture_output=True, text=True, timeout=timeout)
-        return {"ok": res.returncode==0, "code": res.returncode, "stdout": res.stdout, "stderr": res.stderr}
-    except Exception as e:
-        return {"ok": False, "error": str(e)}
+    with metrics.span("cmd", cmd=parts[0]):
+        if pid is None:
+            res = runner.run(parts, cwd, timeout, None, None, None)
+        else:
+            log(None, pid, "cmd", f"$ {cmd}")
+            res = runner.run(parts, cwd, timeout, pid, _live_output(pid, cmd), lambda: _stop_requested(pid))
+    metrics.count("cmd_output_bytes_total", res.get("bytes", 0), cmd=parts[0])
+    if pid is None: return res
+    log(None, pid, "cmd", _summary(cmd, res), meta=json.dumps({"cmd": cmd, "code": res.get("code"), "ok": res["ok"], "truncated": res.get("truncated", False)}))
+    return res
+
+def cancel_cmds(pid: int) -> int:
+    return runner.cancel(pid)
+
+def _live_output(pid: int, cmd: str):
+    # Живые строки в БД не пишутся — только в брокер, как токены чата
+    def on_line(stream: str, line: str):
+        broker.publish(pid, {"event": "output", "data": {"cmd": cmd, "stream": stream, "line": line}})
+    return on_line
+
+def _stop_requested(pid: int) -> bool:
+    with Session(engine) as s:
+        return bool(get_control(s, pid).get("stop"))
+
+def _summary(cmd: str, res: Dict[str, Any]) -> str:
+    head = f"$ {cmd}\nкод выхода: {res.get('code')}" + (f" ({res['error']})" if res.get("error") else "")
+    out = "\n".join(x for x in (res.get("stdout", "").strip(), res.get("stderr", "").strip()) if x)
+    return head + ("\n" + out if out else "")
 
 TOOL_SPEC = [
     {"name":"ensure_dir","description":"Создать каталог","schema":{"path":"str"}},
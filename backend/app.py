@@ -1,14 +1,20 @@
-from fastapi import FastAPI, Body, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Body, HTTPException, WebSocket, WebSocketDisconnect, Request, Query
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse
 from sse_starlette.sse import EventSourceResponse
 from sqlmodel import SQLModel, Session, select
 from typing import Optional, Dict, List
-import pathlib, json, asyncio
+import pathlib, json, asyncio, datetime
 from agent.models import Project, StepLog, ChatMessage, ProjectTask, WorkSchedule
-from agent.runner import bootstrap_project, agent_step, chat_message
-from agent.runner_utils import engine, set_status, log
-from agent.scheduler import schedule_loop
+from agent.runner import bootstrap_project, agent_step_job, index_job, test_job, chat_prepare_job, chat_finish_job
+from agent.llm_client import chat_llm_stream, cache_stats, aclose as llm_aclose
+from agent.runner_utils import engine, set_status, log, log_event, set_control, log_writer
+from agent.events import broker
+from agent.jobs import jobs
+from agent.scheduler import schedule_loop, scheduler
 from agent.rag import build_context_markdown
+from agent.tools import cancel_cmds
+from agent import metrics
 
 app = FastAPI(title="Agent Studio v5 (RU)")
 SQLModel.metadata.create_all(engine)
@@ -19,10 +25,28 @@ ws_clients: Dict[int, List[WebSocket]] = {}
 async def on_start():
     asyncio.create_task(schedule_loop(engine))
 
+@app.on_event("shutdown")
+async def on_stop():
+    jobs.shutdown()
+    log_writer.close()
+    await llm_aclose()
+
+def publish_token(pid: int, item: dict):
+    # Токены не пишутся в БД — только живым подписчикам /stream
+    broker.publish(pid, {"event": "token", "data": item})
+
 @app.get("/")
 def root():
     return {"ok": True, "message": "Agent Studio v5 (RU)"}
 
+@app.get("/llm/cache")
+def llm_cache_stats():
+    return {"ok": True, "cache": cache_stats()}
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/projects")
 def create_project(name: str = Body(...), description: str = Body(""), tech_stack: str = Body(""), repo_url: Optional[str] = Body(None)):
     with Session(engine) as s:
@@ -40,8 +64,54 @@ def get_project(pid: int):
 def run_step(pid: int, task: str = Body(...)):
     with Session(engine) as s:
         if not s.get(Project, pid): raise HTTPException(404, "Проект не найден")
-        agent_step(s, pid, task)
-        return {"ok": True}
+    # Шаг выполняется в пуле воркеров; статус — GET /jobs/{job_id}
+    job = jobs.submit(pid, "agent_step", agent_step_job, pid, task)
+    return {"ok": True, "job_id": job.id}
+
+@app.post("/projects/{pid}/index")
+def run_index(pid: int):
+    with Session(engine) as s:
+        if not s.get(Project, pid): raise HTTPException(404, "Проект не найден")
+    job = jobs.submit(pid, "index", index_job, pid)
+    return {"ok": True, "job_id": job.id}
+
+@app.post("/projects/{pid}/tests")
+def run_project_tests(pid: int, full: bool = Body(False, embed=True), force: bool = Body(False, embed=True)):
+    # full=true — весь набор без выборки по изменениям; зелёный результат для неизменённого дерева берётся из кеша,
+    # force=true — прогнать заново в любом случае
+    with Session(engine) as s:
+        if not s.get(Project, pid): raise HTTPException(404, "Проект не найден")
+    job = jobs.submit(pid, "tests", test_job, pid, full, force)
+    return {"ok": True, "job_id": job.id}
+
+@app.post("/projects/{pid}/control")
+def control(pid: int, pause: Optional[bool] = Body(None), stop: Optional[bool] = Body(None)):
+    with Session(engine) as s:
+        if not s.get(Project, pid): raise HTTPException(404, "Проект не найден")
+        # stop без задач в очереди некому снять — иначе он оборвал бы следующий запуск
+        if stop and not jobs.active(pid): stop = False
+        ctl = set_control(s, pid, pause=pause, stop=stop)
+    cancelled = jobs.cancel_queued(pid) if stop else 0
+    killed = cancel_cmds(pid) if stop else 0
+    if stop and not jobs.active(pid):
+        # Снята запаркованная задача (или всё успело завершиться) — stop некому погасить, делаем это как agent_step
+        with Session(engine) as s:
+            ctl = set_control(s, pid, stop=False)
+            set_status(s, pid, "idle")
+            if cancelled: log(s, pid, "explain", "Шаг остановлен по запросу", role="system")
+    # Паузу сняли — запаркованный шаг возвращается в пул (если окно расписания закрыто, снова запаркуется)
+    if pause is False: jobs.resume(pid)
+    return {"ok": True, "control": ctl, "cancelled": cancelled, "killed": killed}
+
+@app.get("/projects/{pid}/jobs")
+def list_jobs(pid: int):
+    return {"ok": True, "jobs": [j.as_dict() for j in jobs.list(pid)]}
+
+@app.get("/jobs/{jid}")
+def get_job(jid: str):
+    job = jobs.get(jid)
+    if not job: raise HTTPException(404, "Задача агента не найдена")
+    return {"ok": True, "job": job.as_dict()}
 
 # ---- Chat (WS + history) ----
 @app.websocket("/ws/{pid}")
@@ -51,23 +121,105 @@ async def ws_chat(ws: WebSocket, pid: int):
     try:
         while True:
             data = await ws.receive_text()
-            with Session(engine) as s:
-                p = s.get(Project, pid)
-                if not p: 
-                    await ws.send_text("Ошибка: проект не найден"); 
-                    continue
-                reply = chat_message(s, pid, data)
-                await ws.send_text(reply)
+            # Работа с БД и файлами — в потоке, чтобы не блокировать event loop остальным клиентам
+            prepared = await run_in_threadpool(chat_prepare_job, pid, data)
+            if not prepared: 
+                await ws.send_text(json.dumps({"type":"error","content":"Ошибка: проект не найден"}, ensure_ascii=False)); 
+                continue
+            system, history = prepared
+            # Токены уходят клиенту сразу по мере генерации — задержку определяет первый токен
+            parts = []
+            try:
+                async for tok in chat_llm_stream(system, history):
+                    parts.append(tok)
+                    await ws.send_text(json.dumps({"type":"token","content":tok}, ensure_ascii=False))
+                    publish_token(pid, {"role":"assistant","content":tok})
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                # Оборванный ответ не сохраняем как реплику ассистента и done не шлём — клиент получает только error
+                await ws.send_text(json.dumps({"type":"error","content":f"Ошибка LLM: {e}","partial":bool(parts)}, ensure_ascii=False))
+                await run_in_threadpool(log, None, pid, "error", f"Ответ в чате оборван ({len(parts)} фрагм.): {e}")
+                continue
+            reply = "".join(parts)
+            await run_in_threadpool(chat_finish_job, pid, reply)
+            await ws.send_text(json.dumps({"type":"done","content":reply}, ensure_ascii=False))
     except WebSocketDisconnect:
         ws_clients[pid].remove(ws)
 
+# ---- Keyset-пагинация истории чата и логов ----
+EXPORT_BATCH = 1000
+
+def _msg_dict(m: ChatMessage) -> dict:
+    return {"id":m.id,"ts":m.ts.isoformat(),"role":m.role,"content":m.content}
+
+def _log_dict(l: StepLog) -> dict:
+    return {"id":l.id,"ts":l.ts.isoformat(),"type":l.type,"role":l.role,"content":l.content,"meta":l.meta}
+
+def _keyset(s: Session, model, pid: int, after_id: Optional[int], before_id: Optional[int], limit: int, since: Optional[datetime.datetime], **eq):
+    # after_id — дельта «всё новее курсора» (по возрастанию); иначе — последняя страница перед before_id
+    q = select(model).where(model.project_id==pid)
+    for k, v in eq.items():
+        if v is not None: q = q.where(getattr(model, k)==v)
+    if since is not None: q = q.where(model.ts >= since)
+    if after_id is not None:
+        q = q.where(model.id > after_id).order_by(model.id)
+    else:
+        if before_id is not None: q = q.where(model.id < before_id)
+        q = q.order_by(model.id.desc())
+    rows = s.exec(q.limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None: rows = rows[::-1]
+    page = {"has_more": has_more,
+            "next_cursor": rows[-1].id if rows else after_id,
+            "prev_cursor": rows[0].id if rows else before_id}
+    return rows, page
+
+def _ndjson(model, pid: int, after_id: Optional[int], since: Optional[datetime.datetime], to_dict, **eq):
+    # Экспорт пачками по курсору: в памяти не больше EXPORT_BATCH строк, сессия на пачку
+    cursor = after_id or 0
+    while True:
+        with Session(engine) as s:
+            rows, page = _keyset(s, model, pid, cursor, None, EXPORT_BATCH, since, **eq)
+            chunk = "".join(json.dumps(to_dict(r), ensure_ascii=False) + "\n" for r in rows)
+        if chunk: yield chunk
+        if not page["has_more"]: return
+        cursor = page["next_cursor"]
+
+def _require_project(pid: int):
+    with Session(engine) as s:
+        if not s.get(Project, pid): raise HTTPException(404, "Проект не найден")
+
 @app.get("/projects/{pid}/chat/history")
-def chat_history(pid: int):
+def chat_history(pid: int, after_id: Optional[int] = None, before_id: Optional[int] = None, limit: int = Query(200, ge=1, le=1000),
+                 role: Optional[str] = None, since: Optional[datetime.datetime] = None):
     with Session(engine) as s:
         p = s.get(Project, pid)
         if not p: raise HTTPException(404, "Проект не найден")
-        msgs = s.exec(select(ChatMessage).where(ChatMessage.project_id==pid).order_by(ChatMessage.ts)).all()
-        return {"ok": True, "messages": [{"ts":m.ts.isoformat(),"role":m.role,"content":m.content} for m in msgs]}
+        msgs, page = _keyset(s, ChatMessage, pid, after_id, before_id, limit, since, role=role)
+        return {"ok": True, "messages": [_msg_dict(m) for m in msgs], **page}
+
+@app.get("/projects/{pid}/chat/export")
+def chat_export(pid: int, after_id: Optional[int] = None, role: Optional[str] = None, since: Optional[datetime.datetime] = None):
+    _require_project(pid)
+    return StreamingResponse(_ndjson(ChatMessage, pid, after_id, since, _msg_dict, role=role), media_type="application/x-ndjson")
+
+@app.get("/projects/{pid}/logs")
+def list_logs(pid: int, after_id: Optional[int] = None, before_id: Optional[int] = None, limit: int = Query(200, ge=1, le=1000),
+              type_: Optional[str] = Query(None, alias="type"), role: Optional[str] = None, since: Optional[datetime.datetime] = None):
+    _require_project(pid)
+    log_writer.flush()   # буфер логов ещё не в БД — сбрасываем, чтобы выдача была полной
+    with Session(engine) as s:
+        rows, page = _keyset(s, StepLog, pid, after_id, before_id, limit, since, type=type_, role=role)
+        return {"ok": True, "logs": [_log_dict(l) for l in rows], **page}
+
+@app.get("/projects/{pid}/logs/export")
+def logs_export(pid: int, after_id: Optional[int] = None, type_: Optional[str] = Query(None, alias="type"), role: Optional[str] = None,
+                since: Optional[datetime.datetime] = None):
+    _require_project(pid)
+    log_writer.flush()
+    return StreamingResponse(_ndjson(StepLog, pid, after_id, since, _log_dict, type=type_, role=role), media_type="application/x-ndjson")
 
 # ---- Tasks ----
 @app.get("/projects/{pid}/tasks")
@@ -108,26 +260,66 @@ def set_schedule(pid: int, time_window: str = Body(...), days: str = Body("Mon,T
         else:
             row.time_window = time_window; row.days = days; row.enabled = enabled
         s.add(row); s.commit()
-        return {"ok": True}
+    scheduler.invalidate(pid)
+    return {"ok": True}
 
 # ---- Logs SSE ----
+STREAM_BACKLOG = 50
+REPLAY_BATCH = 500
+
+def _logs_after(pid: int, after_id: int | None) -> list[dict]:
+    # БД + ещё не сброшенный буфер log_writer (строки в нём уже разосланы подписчикам)
+    pending = log_writer.pending(pid, after_id)
+    with Session(engine) as s:
+        if after_id is None:
+            rows = s.exec(select(StepLog).where(StepLog.project_id==pid).order_by(StepLog.id.desc()).limit(STREAM_BACKLOG)).all()[::-1]
+        else:
+            rows = s.exec(select(StepLog).where(StepLog.project_id==pid, StepLog.id > after_id).order_by(StepLog.id).limit(REPLAY_BATCH)).all()
+    events = {r.id: log_event(r) for r in rows}
+    if after_id is not None and len(rows) == REPLAY_BATCH:
+        return list(events.values())   # до буфера доберёмся следующей пачкой
+    events.update({r["id"]: log_event(r) for r in pending})
+    out = [events[k] for k in sorted(events)]
+    return out[-STREAM_BACKLOG:] if after_id is None else out
+
+def _sse(ev: dict) -> dict:
+    out = {"event": ev["event"], "data": json.dumps(ev["data"], ensure_ascii=False)}
+    if ev.get("id") is not None: out["id"] = str(ev["id"])
+    return out
+
 @app.get("/stream/{pid}")
-async def stream(pid: int):
+async def stream(pid: int, request: Request):
+    with Session(engine) as s:
+        exists = s.get(Project, pid) is not None
+    last_id = request.headers.get("last-event-id")
+    cursor = int(last_id) if last_id and last_id.isdigit() else None
     async def event_gen():
-        last = None
-        while True:
-            with Session(engine) as s:
-                if not s.get(Project, pid):
-                    yield {"event":"error","data":"Проект не найден"}
-                    return
-                logs = s.exec(select(StepLog).where(StepLog.project_id==pid).order_by(StepLog.ts.desc()).limit(1)).all()
-                if logs:
-                    l = logs[0]
-                    key = f"{l.ts.isoformat()}|{l.id}"
-                    if key != last:
-                        last = key
-                        yield {"event":"log","data":json.dumps({"ts":l.ts.isoformat(),"type":l.type,"role":l.role,"content":l.content}, ensure_ascii=False)}
-            await asyncio.sleep(1.0)
+        nonlocal cursor
+        if not exists:
+            yield {"event":"error","data":"Проект не найден"}
+            return
+        # Подписываемся до догонки из БД, чтобы не потерять события между запросом и подпиской
+        sub = broker.subscribe(pid)
+        try:
+            catch_up = True
+            while True:
+                if catch_up or sub.overflow:
+                    sub.reset()
+                    while True:
+                        batch = await run_in_threadpool(_logs_after, pid, cursor)
+                        for ev in batch:
+                            cursor = ev["id"]
+                            yield _sse(ev)
+                        if cursor is None or len(batch) < REPLAY_BATCH: break
+                    catch_up = False
+                    if cursor is None: cursor = 0
+                ev = await sub.queue.get()
+                if ev.get("id") is not None:
+                    if ev["id"] <= cursor: continue
+                    cursor = ev["id"]
+                yield _sse(ev)
+        finally:
+            broker.unsubscribe(sub)
     return EventSourceResponse(event_gen())
 
 # ---- UI ----
@@ -0,0 +1,77 @@
+import asyncio, json, random, socket, threading, time
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Заглушка LLM с API Ollama (/api/generate): задержка до первого токена и скорость генерации настраиваются,
+# ответ детерминирован по промпту — результаты прогонов сравнимы между коммитами
+WORDS = "проект файл функция модуль тест данные запрос ответ план шаг сервис схема индекс поток".split()
+
+class FakeLLM:
+    def __init__(self, latency: float = 0.2, token_rate: float = 200.0, tokens: int = 60, port: int = 0):
+        self.latency, self.token_rate, self.tokens = latency, token_rate, tokens
+        self.port = port or free_port()
+        self.requests = 0
+        self.app = self._build()
+        self._server: uvicorn.Server | None = None
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/generate"
+
+    def _answer(self, prompt: str) -> list[str]:
+        rnd = random.Random(prompt)
+        return [rnd.choice(WORDS) + " " for _ in range(self.tokens)]
+
+    def _build(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/api/generate")
+        async def generate(request: Request):
+            body = await request.json()
+            self.requests += 1
+            toks = self._answer(body.get("prompt", ""))
+            if not body.get("stream"):
+                await asyncio.sleep(self.latency + len(toks) / self.token_rate)
+                return JSONResponse({"response": "".join(toks), "done": True,
+                                     "prompt_eval_count": len(body.get("prompt", "")) // 4, "eval_count": len(toks)})
+            async def gen():
+                await asyncio.sleep(self.latency)
+                for t in toks:
+                    await asyncio.sleep(1 / self.token_rate)
+                    yield json.dumps({"response": t, "done": False}, ensure_ascii=False) + "\n"
+                yield json.dumps({"response": "", "done": True, "eval_count": len(toks)}) + "\n"
+            return StreamingResponse(gen(), media_type="application/x-ndjson")
+        return app
+
+    def start(self) -> "FakeLLM":
+        self._server = serve_in_thread(self.app, self.port)
+        return self
+
+    def stop(self):
+        if self._server: self._server.should_exit = True
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+def serve_in_thread(app, port: int) -> uvicorn.Server:
+    # uvicorn в фоновом потоке; ждём, пока начнёт принимать соединения
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.monotonic() + 15
+    while not server.started:
+        if time.monotonic() > deadline: raise RuntimeError(f"Сервер на порту {port} не запустился")
+        time.sleep(0.05)
+    return server
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Заглушка LLM для локальной разработки и бенчмарков")
+    ap.add_argument("--port", type=int, default=11435)
+    ap.add_argument("--latency", type=float, default=0.2)
+    ap.add_argument("--token-rate", type=float, default=200.0)
+    ap.add_argument("--tokens", type=int, default=60)
+    a = ap.parse_args()
+    llm = FakeLLM(a.latency, a.token_rate, a.tokens, a.port)
+    uvicorn.run(llm.app, host="127.0.0.1", port=a.port, log_level="warning")
@@ -0,0 +1,268 @@
+import argparse, asyncio, datetime, json, os, pathlib, platform, resource, subprocess, sys, tempfile, threading, time
+import httpx
+
+# Нагрузочный прогон платформы: заглушка LLM + настоящий uvicorn с приложением в этом же процессе.
+# Сценарии: индексация, шаги агента, раздача /stream (SSE), чат по WebSocket, пересчёт расписаний.
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+BACKEND = BENCH_DIR.parent
+SCENARIOS = ("index", "step", "sse", "chat", "scheduler")
+
+def percentile(values: list, q: float) -> float:
+    if not values: return 0.0
+    s = sorted(values)
+    k = (len(s) - 1) * q
+    lo = int(k); hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+def summarize(latencies: list, elapsed: float, ops: int | None = None, **extra) -> dict:
+    ops = len(latencies) if ops is None else ops
+    return {"count": len(latencies), "elapsed_s": round(elapsed, 3), "throughput_per_s": round(ops / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2), "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0, **extra}
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class MemSampler:
+    # Пик RSS процесса (приложение + драйвер) за время сценария
+    def __init__(self, interval: float = 0.05):
+        self.interval, self.peak = interval, rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval): self.peak = max(self.peak, rss_mb())
+
+    def __enter__(self):
+        self._thread.start(); return self
+
+    def __exit__(self, *exc):
+        self._stop.set(); self._thread.join(); self.peak = max(self.peak, rss_mb())
+
+async def wait_job(client: httpx.AsyncClient, jid: str, timeout: float = 600) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = (await client.get(f"/jobs/{jid}")).json().get("job") or {}
+        if job.get("status") in ("done", "error", "cancelled"): return job
+        await asyncio.sleep(0.02)
+    raise TimeoutError(f"Задача {jid} не завершилась за {timeout} с")
+
+async def submit_and_wait(client: httpx.AsyncClient, url: str, body=None) -> tuple[float, dict]:
+    t = time.perf_counter()
+    r = await client.post(url, json=body)
+    job = await wait_job(client, r.json()["job_id"])
+    return time.perf_counter() - t, job
+
+async def create_projects(client: httpx.AsyncClient, n: int, size: str, tag: str) -> list[tuple[int, str]]:
+    from bench.workspace import generate
+    out = []
+    for i in range(n):
+        r = (await client.post("/projects", json={"name": f"bench_{tag}_{i}", "description": "benchmark", "tech_stack": "python"})).json()
+        await asyncio.to_thread(generate, r["workspace"], size, 42 + i)
+        out.append((r["project_id"], r["workspace"]))
+    return out
+
+async def bench_index(client, projects, args) -> dict:
+    from bench.workspace import touch
+    res = {}
+    for phase in ("cold", "touched", "unchanged"):
+        if phase == "touched":
+            for _, wp in projects: await asyncio.to_thread(touch, wp, args.touch)
+        t = time.perf_counter()
+        runs = await asyncio.gather(*(submit_and_wait(client, f"/projects/{pid}/index") for pid, _ in projects))
+        elapsed = time.perf_counter() - t
+        files = sum(sum((job.get("result") or {}).values()) for _, job in runs)
+        failed = sum(1 for _, job in runs if job.get("status") != "done")
+        res[phase] = summarize([lat for lat, _ in runs], elapsed, ops=files, files=files, failed_jobs=failed)
+    return res
+
+async def bench_step(client, projects, args) -> dict:
+    async def project_steps(pid):
+        return [await submit_and_wait(client, f"/projects/{pid}/run", f"Шаг {i}: добавить модуль отчётов") for i in range(args.steps)]
+    t = time.perf_counter()
+    runs = [r for rs in await asyncio.gather(*(project_steps(pid) for pid, _ in projects)) for r in rs]
+    return summarize([lat for lat, _ in runs], time.perf_counter() - t, failed_jobs=sum(1 for _, j in runs if j.get("status") != "done"))
+
+async def bench_sse(client, projects, args) -> dict:
+    # Событие несёт время записи; задержка — от log() до получения клиентом (процесс один, часы общие)
+    from agent.runner_utils import log
+    pids = [pid for pid, _ in projects]
+    latencies, ready = [], 0
+    expected = args.events * args.sse_clients   # каждый клиент получает все события своего проекта
+    done = asyncio.Event()
+
+    async def reader(pid: int):
+        nonlocal ready
+        async with client.stream("GET", f"/stream/{pid}", timeout=None) as r:
+            ready += 1
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"): continue
+                try: d = json.loads(line[5:].strip())
+                except ValueError: continue
+                if not isinstance(d, dict) or d.get("type") != "bench": continue
+                latencies.append(time.perf_counter() - float(d["content"]))
+                if len(latencies) >= expected: done.set()
+
+    readers = [asyncio.create_task(reader(pids[i % len(pids)])) for i in range(args.sse_clients)]
+    while ready < len(readers): await asyncio.sleep(0.01)
+    await asyncio.sleep(0.5)   # дать подписчикам пройти догонку из БД
+
+    def produce():
+        for _ in range(args.events):
+            for pid in pids: log(None, pid, "bench", repr(time.perf_counter()))
+            if args.event_rate: time.sleep(len(pids) / args.event_rate)
+    t = time.perf_counter()
+    await asyncio.to_thread(produce)
+    try: await asyncio.wait_for(done.wait(), 30)
+    except asyncio.TimeoutError: pass
+    elapsed = time.perf_counter() - t
+    for r in readers: r.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    return summarize(latencies, elapsed, clients=args.sse_clients, expected=expected, delivered=len(latencies))
+
+async def bench_chat(base_ws: str, projects, args) -> dict:
+    import websockets
+    pids = [pid for pid, _ in projects]
+    ttft, total = [], []
+
+    async def chat(i: int):
+        async with websockets.connect(f"{base_ws}/ws/{pids[i % len(pids)]}", max_size=None) as ws:
+            for m in range(args.messages):
+                t = time.perf_counter(); first = None
+                await ws.send(f"Сессия {i}, вопрос {m}: как устроен модуль отчётов?")
+                while True:
+                    frame = json.loads(await ws.recv())
+                    if frame["type"] == "token" and first is None: first = time.perf_counter() - t
+                    if frame["type"] in ("done", "error"): break
+                total.append(time.perf_counter() - t); ttft.append(first if first is not None else total[-1])
+    t = time.perf_counter()
+    await asyncio.gather(*(chat(i) for i in range(args.chats)))
+    elapsed = time.perf_counter() - t
+    return {"total": summarize(total, elapsed), "first_token": summarize(ttft, elapsed)}
+
+def bench_scheduler(args) -> dict:
+    # Полный пересчёт окон для N проектов (как при старте) и точечные invalidate → пересчёт одного проекта
+    from sqlmodel import Session
+    from agent.runner_utils import engine
+    from agent.models import Project, WorkSchedule
+    from agent.scheduler import Scheduler
+    with Session(engine) as s:
+        rows = [Project(name=f"sched_{i}", description="", tech_stack="", workspace_path="") for i in range(args.schedules)]
+        s.add_all(rows); s.commit()
+        s.add_all([WorkSchedule(project_id=p.id, time_window="22:00-06:00" if p.id % 2 else "09:00-18:00", enabled=True) for p in rows]); s.commit()
+        pids = [p.id for p in rows]
+    sched = Scheduler()
+    full = []
+    for _ in range(args.repeat):
+        t = time.perf_counter(); now = datetime.datetime.now(sched.tz)
+        loaded = sched._reload(engine, None)
+        for pid in loaded: sched._schedule(pid, now)
+        sched._apply(engine, loaded, now)
+        full.append(time.perf_counter() - t)
+    single, t0 = [], time.perf_counter()
+    for pid in pids[:200]:
+        t = time.perf_counter(); now = datetime.datetime.now(sched.tz)
+        sched._reload(engine, {pid}); sched._schedule(pid, now); sched._apply(engine, {pid}, now)
+        single.append(time.perf_counter() - t)
+    return {"full_reload": summarize(full, sum(full), ops=len(full) * len(pids), projects=len(pids)),
+            "invalidate": summarize(single, time.perf_counter() - t0)}
+
+def git_commit() -> tuple[str, bool]:
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND, capture_output=True, text=True).stdout.strip() or "unknown"
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BACKEND, capture_output=True, text=True).stdout.strip())
+        return sha, dirty
+    except OSError:
+        return "unknown", False
+
+async def run_all(args, app_url: str) -> dict:
+    results = {}
+    limits = httpx.Limits(max_connections=args.sse_clients + args.projects * 4 + 20)
+    async with httpx.AsyncClient(base_url=app_url, timeout=120, limits=limits) as client:
+        projects = await create_projects(client, args.projects, args.size, str(int(time.time())))
+        for name in args.scenarios:
+            print(f"→ {name}", flush=True)
+            with MemSampler() as mem:
+                if name == "index": r = await bench_index(client, projects, args)
+                elif name == "step": r = await bench_step(client, projects, args)
+                elif name == "sse": r = await bench_sse(client, projects, args)
+                elif name == "chat": r = await bench_chat(app_url.replace("http://", "ws://"), projects, args)
+                else: r = await asyncio.to_thread(bench_scheduler, args)
+            r["peak_rss_mb"] = round(mem.peak, 1)
+            results[name] = r
+    return results
+
+def _flat(d: dict, prefix: str = "") -> dict:
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict): out.update(_flat(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)): out[prefix + k] = v
+    return out
+
+def compare(a_path: str, b_path: str):
+    # Разница двух прогонов: латентность (p50/p99) меньше — лучше, пропускная способность больше — лучше
+    a, b = (json.loads(pathlib.Path(p).read_text(encoding="utf-8")) for p in (a_path, b_path))
+    fa, fb = _flat(a["results"]), _flat(b["results"])
+    print(f"{a['commit']} → {b['commit']}")
+    for key in sorted(set(fa) & set(fb)):
+        if not key.endswith(("p50_ms", "p99_ms", "throughput_per_s", "peak_rss_mb")): continue
+        old, new = fa[key], fb[key]
+        delta = (new - old) / old * 100 if old else 0.0
+        print(f"  {key:45s} {old:>12.2f} {new:>12.2f} {delta:>+8.1f}%")
+
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарки Agent Platform (заглушка LLM, синтетические проекты)")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help="через запятую: " + ", ".join(SCENARIOS))
+    ap.add_argument("--size", default="small", choices=("small", "medium", "large"))
+    ap.add_argument("--projects", type=int, default=4)
+    ap.add_argument("--steps", type=int, default=2, help="шагов агента на проект")
+    ap.add_argument("--touch", type=int, default=5, help="сколько файлов менять перед повторной индексацией")
+    ap.add_argument("--sse-clients", type=int, default=50)
+    ap.add_argument("--events", type=int, default=200, help="событий лога на проект для сценария sse")
+    ap.add_argument("--event-rate", type=float, default=0, help="событий в секунду (0 — без ограничения)")
+    ap.add_argument("--chats", type=int, default=8)
+    ap.add_argument("--messages", type=int, default=3)
+    ap.add_argument("--schedules", type=int, default=1000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--llm-latency", type=float, default=0.05, help="задержка до первого токена, с")
+    ap.add_argument("--token-rate", type=float, default=500.0, help="токенов в секунду")
+    ap.add_argument("--llm-tokens", type=int, default=40)
+    ap.add_argument("--out", default=str(BENCH_DIR / "results"))
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="сравнить два сохранённых прогона и выйти")
+    args = ap.parse_args()
+    if args.compare: return compare(*args.compare)
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown: ap.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    sys.path.insert(0, str(BACKEND))
+    from bench.fake_llm import FakeLLM, free_port, serve_in_thread
+    llm = FakeLLM(args.llm_latency, args.token_rate, args.llm_tokens).start()
+    tmp = tempfile.mkdtemp(prefix="agent-bench-")
+    # Настройки читаются при импорте приложения — окружение задаём до него. Кеш LLM выключен:
+    # иначе повторные прогоны меряли бы кеш, а не путь запроса
+    os.environ.update({"LLM_ENDPOINT": llm.endpoint, "DATABASE_URL": f"sqlite:///{tmp}/state.db", "WORKSPACE_ROOT": f"{tmp}/workspaces",
+                       "LLM_CACHE": "false", "LLM_CACHE_PATH": f"{tmp}/llm_cache.db"})
+    import app as app_module
+    port = free_port()
+    server = serve_in_thread(app_module.app, port)
+    started = time.perf_counter()
+    results = asyncio.run(run_all(args, f"http://127.0.0.1:{port}"))
+    server.should_exit = True; llm.stop()
+
+    sha, dirty = git_commit()
+    report = {"commit": sha, "dirty": dirty, "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "platform": platform.platform(), "duration_s": round(time.perf_counter() - started, 1),
+              "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+              "llm_requests": llm.requests, "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), "results": results}
+    out = pathlib.Path(args.out); out.mkdir(parents=True, exist_ok=True)
+    path = out / f"{sha}{'-dirty' if dirty else ''}-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    print(f"Результаты: {path}")
+
+if __name__ == "__main__":
+    main()
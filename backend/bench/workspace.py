@@ -0,0 +1,49 @@
+import pathlib, random
+
+# Синтетические workspace: исходники разных типов, .gitignore, node_modules/vendor (должны отсекаться сканером)
+SIZES = {
+    "small":  {"files": 40,   "dirs": 4,  "noise": 200},
+    "medium": {"files": 300,  "dirs": 20, "noise": 3000},
+    "large":  {"files": 1500, "dirs": 60, "noise": 20000},
+}
+KINDS = (".py", ".js", ".ts", ".php", ".md", ".json")
+
+def _body(rnd: random.Random, suffix: str, i: int) -> str:
+    lines = rnd.randint(20, 200)
+    if suffix == ".py":
+        return "\n".join([f"def func_{i}_{n}(x):\n    return x * {n}  # обработка запроса {n}" for n in range(lines // 2)]) + "\n"
+    if suffix in (".js", ".ts"):
+        return "\n".join([f"export function handler{i}_{n}(req) {{ return req.id + {n}; }}" for n in range(lines)]) + "\n"
+    if suffix == ".php":
+        return "<?php\n" + "\n".join([f"function action_{i}_{n}($r) {{ return $r + {n}; }}" for n in range(lines)]) + "\n"
+    if suffix == ".json":
+        return "{" + ",".join(f'"key{n}": {n}' for n in range(lines)) + "}\n"
+    return f"# Документ {i}\n\n" + "\n".join(f"Раздел {n}: описание сервиса и схемы данных." for n in range(lines)) + "\n"
+
+def generate(root: str, size: str = "small", seed: int = 42) -> dict:
+    # Детерминированно по seed: одинаковые входные данные для сравнения коммитов
+    spec = SIZES[size]
+    rnd = random.Random(seed)
+    base = pathlib.Path(root); base.mkdir(parents=True, exist_ok=True)
+    dirs = [base / "src" / f"pkg{d}" for d in range(spec["dirs"])]
+    total = 0
+    for i in range(spec["files"]):
+        suffix = KINDS[i % len(KINDS)]
+        p = rnd.choice(dirs) / f"file_{i}{suffix}"
+        p.parent.mkdir(parents=True, exist_ok=True)
+        text = _body(rnd, suffix, i)
+        p.write_text(text, encoding="utf-8"); total += len(text)
+    noise = base / "node_modules" / "dep"
+    noise.mkdir(parents=True, exist_ok=True)
+    for i in range(spec["noise"]):
+        (noise / f"m{i}.js").write_text("module.exports = 1;\n", encoding="utf-8")
+    (base / ".gitignore").write_text("node_modules/\n*.log\n", encoding="utf-8")
+    return {"size": size, "files": spec["files"], "noise_files": spec["noise"], "bytes": total}
+
+def touch(root: str, count: int, seed: int = 7) -> int:
+    # Изменить count исходников — для замера инкрементальной переиндексации
+    files = sorted(p for p in (pathlib.Path(root) / "src").rglob("*") if p.is_file())
+    rnd = random.Random(seed)
+    for p in rnd.sample(files, min(count, len(files))):
+        with open(p, "a", encoding="utf-8") as f: f.write("\n// изменено\n" if p.suffix in (".js", ".ts", ".php") else "\n# изменено\n")
+    return min(count, len(files))
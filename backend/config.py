@@ -6,6 +6,35 @@ class Settings(BaseSettings):
     github_repo_url: str | None = os.getenv("GITHUB_REPO_URL")
     llm_endpoint: str = os.getenv("LLM_ENDPOINT", "http://localhost:11434/api/generate")
     llm_model: str = os.getenv("LLM_MODEL", "gpt-oss:20b")
+    llm_timeout: float = float(os.getenv("LLM_TIMEOUT", "120"))
+    llm_retries: int = int(os.getenv("LLM_RETRIES", "2"))
+    llm_concurrency: int = int(os.getenv("LLM_CONCURRENCY", "4"))
+    llm_cache: bool = os.getenv("LLM_CACHE", "true").lower() == "true"
+    llm_cache_path: str = os.getenv("LLM_CACHE_PATH", "llm_cache.db")
+    llm_cache_items: int = int(os.getenv("LLM_CACHE_ITEMS", "2048"))
+    llm_cache_rows: int = int(os.getenv("LLM_CACHE_ROWS", "50000"))
+    llm_cache_ttl: float = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+    job_workers: int = int(os.getenv("JOB_WORKERS", "4"))
+    stream_queue_size: int = int(os.getenv("STREAM_QUEUE_SIZE", "1000"))
+    database_url: str = os.getenv("DATABASE_URL", "sqlite:///state.db")
+    db_busy_timeout_ms: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    log_batch_size: int = int(os.getenv("LOG_BATCH_SIZE", "200"))
+    log_flush_ms: int = int(os.getenv("LOG_FLUSH_MS", "250"))
+    rag_top_k: int = int(os.getenv("RAG_TOP_K", "8"))
+    rag_context_tokens: int = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+    rag_index_projects: int = int(os.getenv("RAG_INDEX_PROJECTS", "16"))
+    chat_history_tokens: int = int(os.getenv("CHAT_HISTORY_TOKENS", "1500"))
+    chat_summary_tokens: int = int(os.getenv("CHAT_SUMMARY_TOKENS", "300"))
+    scan_max_file_bytes: int = int(os.getenv("SCAN_MAX_FILE_BYTES", "1000000"))
+    cmd_max_parallel: int = int(os.getenv("CMD_MAX_PARALLEL", "4"))
+    cmd_max_per_project: int = int(os.getenv("CMD_MAX_PER_PROJECT", "1"))
+    cmd_output_head: int = int(os.getenv("CMD_OUTPUT_HEAD", "16000"))
+    cmd_output_tail: int = int(os.getenv("CMD_OUTPUT_TAIL", "32000"))
+    test_full_every: int = int(os.getenv("TEST_FULL_EVERY", "10"))
+    test_workers: int = int(os.getenv("TEST_WORKERS", "0"))
+    test_timeout: int = int(os.getenv("TEST_TIMEOUT", "1800"))
+    metrics_enabled: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
     workspace_root: str = os.getenv("WORKSPACE_ROOT", "./workspaces")
     allow_run_cmd: bool = os.getenv("ALLOW_RUN_CMD", "true").lower() == "true"
     timezone: str = os.getenv("TIMEZONE", "Europe/Moscow")